@@ -6,51 +6,114 @@ import zulip
 import dotenv
 
 import requests
-import json
+import urlparse
 import os
 import sys
 import time
+import socket
+import random
+import logging
 
 import database
+import scheduler
+import timingwheel
 import timeconversions as TC
 import delaymessage
 import help
+import logs
+import runtime
+import streams
+import recurrence
+import outbox
+import shards
+import bulk
+import router
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# how many users' places in their queue listing are remembered for `queue next`
+QUEUE_CURSORS = 10000
+# the most overdue messages a sync picks up, later syncs get the rest
+SYNC_DUE_LIMIT = 10000
+
+
+def underscores_to_spaces(name):
+    """Reads a stream or topic name, where spaces are written as underscores"""
+    return name.replace("_", " ")
+
+
+def parse_unqueue_ids(terms):
+    """Reads the terms after unqueue, which are either ids or `ALL`"""
+    if terms == ["ALL"]:
+        return "ALL"
+    if not all(term.isdigit() for term in terms):
+        raise ValueError("You need to specify only numbers or `ALL`")
+    return [int(term) for term in terms]
 
 
 class DelayBot(object):
 
-    def __init__(self, zulip_username, zulip_api_key, key_word, subscribed_streams=[]):
+    def __init__(self, zulip_username, zulip_api_key, key_word, subscribed_streams=[],
+                    dispatch_limit=50, state_file=None, stream_cache=None,
+                    timezone=None, page_size=20, send_rate=2, send_burst=10,
+                    coalesce=0, worker_id=None, lease=300, client=None, site=None,
+                    wheel_tick=0):
         """
         DelayBot takes a Zulip username and API key,
         a key word to respond to (case insensitive),
         and a list of the Zulip streams it should be active in.
+        dispatch_limit caps how many delayed messages are sent per loop,
+        so a burst of them can't starve event handling.
+        state_file is where the event queue is saved, so restarts resume it.
+        stream_cache is where stream names are saved, so restarts don't
+        need to fetch them all again.
+        timezone is the tz database name clock times are read in.
+        page_size is how many queued messages are listed at once.
+        send_rate and send_burst limit messages sent per second, on average
+        and at once, and coalesce is how many seconds replies are held so
+        several to one user go out together (0 sends each right away).
+        worker_id names this DelayBot among any others sharing its database,
+        and lease is how many seconds a message it is sending stays claimed.
+        client replaces the Zulip client, ie with a fake one for benchmarks.
+        site is the Zulip server to use, ie a fakezulip one for load tests.
+        wheel_tick schedules messages on a timing wheel with ticks that
+        many seconds long, for millions of them, 0 keeps a heap.
         """
         self.username = zulip_username
         self.api_key = zulip_api_key
         self.key_word = key_word.lower()
+        self.dispatch_limit = dispatch_limit
+        self.state_file = state_file
+        self.timezone = TC.get_timezone(timezone)
+        self.page_size = page_size
+        self.worker_id = worker_id or "%s-%d-%04x" % (
+                socket.gethostname(), os.getpid(), random.getrandbits(16))
+        self.lease = lease
+        # user -> (timestamp, id) of the last message they were listed,
+        # for the users who listed their queue most recently
+        self.queue_cursors = TC.LRUCache(QUEUE_CURSORS)
+        # the highest message id read from the database, syncs read above it
+        self.synced_id = 0
+        # stream and subscription events keep self.streams up to date
+        self.event_types = ["message", "stream", "subscription"]
 
         self.subscribed_streams = subscribed_streams
-        self.client = zulip.Client(zulip_username, zulip_api_key)
-        self.subscriptions = self.subscribe_to_streams()
-        self.stream_names = []
-        for stream in self.subscriptions:
-            self.stream_names.append(stream["name"])
-        
-
-    @property
-    def streams(self):
-        """Standardizes a list of streams in the form [{"name": stream}]"""
-        if not self.subscribed_streams:
-            streams = [{"name": stream["name"]} for stream in self.get_all_zulip_streams()]
-            return streams
-        else: 
-            streams = [{"name": stream} for stream in self.subscribed_streams]
-            return streams
+        self.client = client or zulip.Client(zulip_username, zulip_api_key, site=site)
+        self.outbox = outbox.Outbox(self.client, send_rate, send_burst, coalesce)
+        self.streams = streams.StreamRegistry(stream_cache)
+        self.subscribe_to_streams()
+        if wheel_tick:
+            self.scheduler = timingwheel.TimingWheel(wheel_tick)
+        else:
+            self.scheduler = scheduler.Scheduler()
+        self.router = self.make_router()
 
 
     def get_all_zulip_streams(self):
         """Call Zulip API to get a list of all streams"""
-        response = requests.get("https://api.zulip.com/v1/streams", auth=(self.username, self.api_key))
+        response = requests.get(urlparse.urljoin(self.client.base_url, "v1/streams"),
+                                auth=(self.username, self.api_key))
         if response.status_code == 200:
             return response.json()["streams"]
         elif response.status_code == 401:
@@ -60,167 +123,336 @@ class DelayBot(object):
 
 
     def subscribe_to_streams(self):
-        """Subscribes to Zulip streams"""
-        streams = self.streams
-        self.client.add_subscriptions(streams)
-        return streams
+        """
+        Subscribes to the given Zulip streams, or every stream if none were
+        A fresh stream cache means every stream is already subscribed to
+        """
 
+        if self.subscribed_streams:
+            names = self.subscribed_streams
+        elif self.streams.load():
+            return
+        else:
+            names = [stream["name"] for stream in self.get_all_zulip_streams()]
 
-    def register(self):
+        self.client.add_subscriptions([{"name": name} for name in names])
+        self.streams.replace(names)
+
+
+    def update_streams(self, event):
         """
-        Keeps trying to register the bot until successful
-        Returns queue_id and last_event_id on success
+        Keeps track of streams from "stream" and "subscription" events
+        New streams are subscribed to if DelayBot is in every stream
         """
-        queue_id = None
-        while queue_id == None:
-            # print "Attempting to register..."
-            registration = self.client.register(json.dumps(["message"]))
-            queue_id = registration.get("queue_id")
-            last_event_id = registration.get("last_event_id")
-        return queue_id, last_event_id
+
+        created = self.streams.apply_event(event)
+        if created and not self.subscribed_streams:
+            self.client.add_subscriptions([{"name": name} for name in created])
 
 
     def send_private_message(self, to, content):
         """Minimal requirements for sending a private message"""
-        self.client.send_message({
-            "type": "private",
-            "to": to,
-            "content": content
-        })
+        self.outbox.reply(to, content)
 
 
-    def parse_destination(self, content, msg, private): 
+    def fetch_upload(self, path):
         """
-        Parses and returns the stream and topic
-        If the message is private, stream and topic must be user specified
-        Otherwise, stream and topic can be taken from the msg metadata
+        Downloads a file uploaded to Zulip, given its /user_uploads/ path
+        Stops as soon as it is too large or too slow, see bulk.read_download
         """
-        if private:
-            stream = content[2].replace("_", " ")
-            topic = content[3].replace("_", " ")
-        else:
-            stream = msg["display_recipient"]
-            topic = msg["subject"]
 
-        return stream, topic
+        error = ValueError("I couldn't download the file %s." % path.split("/")[-1])
+        deadline = time.time() + bulk.UPLOAD_TIMEOUT
+        try:
+            response = requests.get(urlparse.urljoin(self.client.base_url, path),
+                                    auth=(self.username, self.api_key),
+                                    stream=True, timeout=bulk.UPLOAD_TIMEOUT)
+        except requests.RequestException:
+            raise error
+        try:
+            if response.status_code != 200:
+                raise error
+            if int(response.headers.get("Content-Length") or 0) > bulk.MAX_UPLOAD:
+                raise bulk.too_large()
+            return bulk.read_download(response.iter_content(bulk.CHUNK_SIZE), deadline)
+        except requests.RequestException:
+            raise error
+        finally:
+            response.close()
+
+
+    def make_router(self):
+        """Registers every command with the args it takes"""
+
+        time_error = ("Not enough commands given. You must specify "
+                        "a delay time%s when calling me from %s.")
+        commands = router.Router(self.key_word)
+        commands.add("ping", self.ping)
+        commands.add("help", self.show_help)
+        commands.add("queue", self.queue, [router.Arg("page", optional=True)])
+        commands.add("unqueue", self.unqueue, [router.Rest("ids", parse_unqueue_ids)],
+                    missing="You need to specify `id` or `ALL`")
+        commands.add("bulk", self.bulk, [router.Body("text")],
+                    missing="Put one delay message on each line after `bulk`.")
+
+        # "delaybot time message" from a stream, and
+        # "delaybot time stream topic message" from a private message
+        args = [router.Arg("user_time"), router.Body("message")]
+        private_args = [router.Arg("user_time"), router.Arg("stream", underscores_to_spaces),
+                        router.Arg("topic", underscores_to_spaces), router.Body("message")]
+        missing = time_error % (" and message", "public streams")
+        private_missing = time_error % (", stream, topic, and message", "a private message")
+        # a delay message is the default, so needs no command word,
+        # and "delaybot (every/daily/weekdays) time ..." is a repeating one
+        for kind in (None,) + recurrence.KINDS:
+            commands.add(kind, self.parse_delay_message, args, private_args,
+                        missing, private_missing, {"rule_kind": kind})
+        return commands
 
 
-    def is_delaybot_call(self, content, sender):
+    def respond(self, msg):
         """
-        Verifies whether or not a given message is directed to DelayBot
-        Raises a ValueError if no commands were given
+        Handles parsing commands, and calling other major functions
+        to process them. Redirects output on success/fatally bad input
         """
 
         # recursion is denied
-        if "delaybot" in sender.lower():
-            return False
-        if self.key_word in content[0].lower():
-            # call is "DelayBot" with no following arguments
-            if len(content) == 1:
-                raise ValueError("You must specify a command when calling me.")
-            # call looks like "DelayBot ..."
-            else:
-                return True
-        # DelayBot was not referenced
+        if "delaybot" in msg["sender_full_name"].lower():
+            return None
+        # chatter is turned away here, by the first term alone
+        routed = self.router.route(msg["content"], msg["type"] == "private")
+        if routed is None:
+            return None
+        command, args = routed
+        response = command.handler(msg, **args)
+
+        # long responses come as a series of messages
+        if isinstance(response, basestring):
+            response = [response]
+        for chunk in response:
+            self.send_private_message(msg["sender_email"], chunk)
+
+
+    def ping(self, msg):
+        return "I am on. What's up?"
+
+
+    def show_help(self, msg):
+        return help.help_string
+
+
+    def build_delay_message(self, msg, user_time, message, stream=None, topic=None,
+                            rule_kind=None):
+        """
+        Makes a delay message from a command, without storing it
+        Without a stream and topic it goes to the ones msg was sent in
+        rule_kind makes it repeat, see recurrence.KINDS
+        Raises a ValueError if the command is invalid
+        """
+
+        rule = None
+        if rule_kind is None:
+            timestamp = TC.parse_time(user_time, msg["timestamp"], self.timezone)
         else:
-            return False
+            rule = recurrence.parse_rule(rule_kind, user_time)
+            timestamp = recurrence.first_fire(rule, msg["timestamp"], self.timezone)
+        if stream is None:
+            stream = msg["display_recipient"]
+            topic = msg["subject"]
+        # "delaybot time stream topic message" with an non-existant stream
+        if stream not in self.streams:
+            raise ValueError("I am not in the stream \"%s\". Check capitals,"
+                "spelling, and replace spaces with underscores." % stream)
+
+        return delaymessage.make_delay_message(msg["timestamp"], timestamp,
+                        msg["sender_full_name"], stream, topic, message,
+                        recurrence.format_rule(rule) if rule else None)
 
 
-    def is_valid_call(self, content, command, private):
+    def parse_delay_message(self, msg, user_time, message, stream=None, topic=None,
+                            rule_kind=None):
         """
-        Validates a given command to check if it can be parsed further
-        Raises a ValueError on fatally incorrect inputs
+        Stores and schedules a delay message from a command
+        rule_kind makes it repeat, see recurrence.KINDS
         """
 
-        activation_word = content[0].lower()
-        content_length = len(content)
-        unqueue_error = "You need to specify %s or `ALL`"
-        time_error = ("Not enough commands given. You must specify "
-                        "a delay time%s when calling me from %s.")
+        dm = self.build_delay_message(msg, user_time, message, stream, topic, rule_kind)
+        message_id = database.add_message_to_db(dm)
+        self.scheduler.push(dm.timestamp, message_id)
+        response = "You have delayed a message to %s" % TC.format_time(dm.timestamp, self.timezone)
+        if dm.rule:
+            response += ", repeating %s" % recurrence.describe(recurrence.load_rule(dm.rule))
+        return response
 
-        # "delaybot (ping/help/queue)"
-        if command in ("ping", "help", "queue"):
-            return True
-
-        elif command == "unqueue":
-            # "delaybot unqueue" no id
-            if content_length < 3:
-                raise ValueError(unqueue_error % "`id`")
-            # "delaybot unqueue [term]" where term is not a number or "ALL"
-            elif not (content[2].isdigit() or content[2] == "ALL"):
-                raise ValueError(unqueue_error % "a number")
-            # "delaybot unqueue [number/ALL]"
-            else:
-                return True
-
-        # "delaybot time message" but no stream and/or topic
-        elif private and content_length < 5:
-            raise ValueError(time_error % (", stream, topic, and message",
-                            "a private message"))
-        # "delaybot time" but no message
-        elif content_length < 3:
-            raise ValueError(time_error % (" and message ", "public streams"))
-        # "delaybot time message" or "delaybot time steam topic message"
-        else:
-            return True
-            
 
-    def respond(self, msg):
+    def parse_bulk_line(self, line, msg):
+        """Makes a delay message from one line of a bulk command, read as a private message"""
+        command, args = self.router.route(line, True)
+        if command.handler != self.parse_delay_message:
+            raise ValueError("`%s` can't be used in bulk, only delay messages can." % command.name)
+        return self.build_delay_message(msg, **args)
+
+
+    def bulk(self, msg, text):
         """
-        Handles parsing commands, and calling other major functions
-        to process them. Redirects output on success/fatally bad input
+        Stores and schedules a delay message for each line, written as in
+        a private message, or for each row of an uploaded CSV or JSON file
+        Every line is checked first, so none are stored if any is invalid
+        """
+
+        commands = bulk.read_lines(text.split("\n"), self.fetch_upload)
+        if not commands:
+            raise ValueError("Put one delay message on each line after `bulk`.")
+        if len(commands) > bulk.BULK_LIMIT:
+            raise ValueError("You can delay at most %d messages at once, not %d." % (
+                                bulk.BULK_LIMIT, len(commands)))
+
+        dms = []
+        errors = []
+        for number, line in enumerate(commands, 1):
+            try:
+                dms.append(self.parse_bulk_line(line, msg))
+            except ValueError as e:
+                errors.append((number, e.message))
+        if errors:
+            raise ValueError("None of your messages were delayed.\n%s\n" %
+                                bulk.describe_errors(errors))
+
+        database.add_messages_to_db(dms)
+        for dm in dms:
+            self.scheduler.push(dm.timestamp, dm.id)
+        first = min(dm.timestamp for dm in dms)
+        last = max(dm.timestamp for dm in dms)
+        plural = min(len(dms) - 1, 1)
+        return "You have delayed %d message%s, from %s to %s" % (len(dms), "s" * plural,
+                    TC.format_time(first, self.timezone), TC.format_time(last, self.timezone))
+
+
+    def queue(self, msg, page="1"):
+        """
+        Lists a page of the sender's queued messages, page can be a
+        number, or "next" for the page after the last one they saw
+        Returns an iterator of messages to send them
         """
 
-        content = msg["content"].split(" ")
         sender = msg["sender_full_name"]
-        private = msg["type"] == "private"
-        # "DelayBot" is not neccesary to start off a private command
-        if private and content[0].lower() != self.key_word:
-            content = [self.key_word] + content
+        after = None
+        page = page.lower()
+        if page == "next":
+            # a forgotten cursor starts the listing over
+            after = self.queue_cursors.get(sender)
+        elif page.isdigit() and int(page) > 0:
+            # only `next` is keyset paged, numbered pages find where they
+            # start with an OFFSET, so deep ones still cost more
+            if int(page) > 1:
+                after = database.get_queue_key(sender, (int(page) - 1) * self.page_size - 1)
+                if after is None:
+                    return "You have no messages on page %s." % page
+        else:
+            raise ValueError("You can only give a page number or `next` after `queue`.")
 
-        if not self.is_delaybot_call(content, sender):
-            return None
-        command = content[1].lower()
-        if not self.is_valid_call(content, command, private):
-            return None
+        # one extra shows whether there is another page
+        dms = database.get_queue_page(sender, after, self.page_size + 1)
+        more = len(dms) > self.page_size
+        dms = dms[:self.page_size]
+        if not dms and after is not None:
+            return "You have no more messages queued."
+        if dms:
+            self.queue_cursors.put(sender, (dms[-1].timestamp, dms[-1].id))
+        return delaymessage.chunk_lines(
+                delaymessage.render_queue(dms, self.timezone, more))
 
-        if command == "ping":
-            response = "I am on. What's up?"
-        elif command == "help":
-            response = help.help_string
-        elif command == "queue":
-            response = database.get_queue(sender)
-        elif command == "unqueue":
-            if content[2].isdigit():
-                content[2] = int(content[2])
-            response = database.unqueue(sender, content[2])
-        else:
-            response = self.parse_delay_message(content, msg, private)
 
-        self.send_private_message(msg["sender_email"], response)
+    def unqueue(self, msg, ids):
+        """
+        Unqueues the sender's messages with the given ids, or all of them
+        if ids is "ALL", and takes them off the schedule
+        """
+
+        dropped = database.unqueue(msg["sender_full_name"], ids)
+        for message_id in dropped:
+            self.scheduler.cancel(message_id)
 
+        if not dropped:
+            return "You have nothing queued with that ID."
+        plural = min(len(dropped) - 1, 1)
+        response = "Successfully unqueued your message%s!" % ("s" * plural)
+        if ids != "ALL":
+            missing = sorted(set(ids) - set(dropped))
+            if missing:
+                response += " You have nothing queued with the ID%s %s." % (
+                    "s" * min(len(missing) - 1, 1),
+                    ", ".join(str(message_id) for message_id in missing))
+        return response
 
-    def parse_delay_message(self, content, msg, private):
-        """Write me"""
 
-        timestamp, date, zulipdate = TC.parse_time(content[1], msg["timestamp"])
-        stream, topic = self.parse_destination(content, msg, private)
-        # "delaybot time stream topic message" with an non-existant stream
-        if stream not in self.stream_names:
-            raise ValueError("I am not in the stream \"%s\". Check capitals,"
-                "spelling, and replace spaces with underscores." % stream)
+    def send_due_messages(self):
+        """
+        Sends scheduled delay_messages that are now due, up to dispatch_limit
+        Any left over stay scheduled and go out on the next loop
+        """
 
-        # a public command looks like "DelayBot [time] [message...]"
-        message_offset = 2
-        # but private commands include "[stream] [topic]"
-        if private:
-            message_offset = 4
-        message = " ".join([x for x in content[message_offset:]])
+        due = self.scheduler.pop_due(time.time(), self.dispatch_limit)
+        now = int(time.time())
+        lease_until = now + self.lease
+        # messages unqueued, rescheduled or claimed by another worker
+        # after being scheduled here will not be returned
+        claimed = database.claim_messages(due, self.worker_id, now, lease_until)
+        sent = []
+        deferred = []
+        for i, dm in enumerate(claimed):
+            # a slow batch renews its lease before half of it runs out
+            if time.time() > lease_until - self.lease // 2:
+                lease_until = int(time.time()) + self.lease
+                database.renew_claims([left.id for left in claimed[i:]],
+                                        self.worker_id, lease_until)
+
+            msg = delaymessage.make_zulip_message(dm, self.timezone)
+            status = self.outbox.send(msg)
+            if status == outbox.DEFERRED:
+                # stays in the database until Zulip confirms it
+                deferred.append(dm.id)
+                continue
+            # rejected messages would only be rejected again
+            sent.append(dm)
+            metrics.DELIVERY_LAG.observe(time.time() - dm.timestamp)
+            logger.debug("Sent message %s from %s (%s)", dm.id, dm.user, status)
+
+        retry = int(time.time()) + outbox.DEFER_DELAY
+        database.defer_messages(deferred, self.worker_id, retry)
+        for message_id in deferred:
+            self.scheduler.push(retry, message_id)
+        for dm, next_timestamp in database.finish_messages(sent, self.next_fire,
+                                                            self.worker_id):
+            if next_timestamp is not None:
+                self.scheduler.push(next_timestamp, dm.id)
+
+
+    def read_pending(self, after=0):
+        """Yields database.get_pending's pairs, recording the highest id read"""
+        for timestamp, message_id in database.get_pending(after):
+            if message_id > self.synced_id:
+                self.synced_id = message_id
+            yield timestamp, message_id
+
+
+    def sync_schedule(self):
+        """
+        Schedules messages other workers queued since the last sync, which
+        have ids above any read so far, and due ones no worker holds, as
+        when a worker stopped while sending them or gave up on them
+        Only needed when several DelayBots share a database
+        """
+        self.scheduler.merge(self.read_pending(self.synced_id))
+        self.scheduler.merge(database.get_due(int(time.time()), SYNC_DUE_LIMIT))
 
-        dm = delaymessage.make_delay_message(zulipdate, timestamp, date,
-                        msg["sender_full_name"], stream, topic, message)
-        database.add_message_to_db(dm)
-        return "You have delayed a message to %s (Eastern Time)" % date
+
+    def next_fire(self, dm):
+        """Returns when a repeating delay message is due next, or None"""
+        if dm.rule is None:
+            return None
+        rule = recurrence.load_rule(dm.rule)
+        return recurrence.next_fire(rule, dm.timestamp, int(time.time()), self.timezone)
 
 
     def handle_error(self, e, sender):
@@ -230,65 +462,118 @@ class DelayBot(object):
         error = error.replace(" H", " Hour")
         error = error.replace(" M", " Minute")
         error = error.replace(" S", " Second")
-        print error
+        logger.info("Rejected a command from %s: %s", sender, error)
         error += " If you want more details, you can call `DelayBot help`."
         self.send_private_message(sender, error)
 
 
-    def main(self):
-        """Write me"""
-
-        # this both checks that DelayBot is on, and will create
-        # the entire database and its' columns if it doesn't exist
-        boot_message = delaymessage.make_delay_message(
-            "(just now)", int(time.time()), "N/A", "DelayBot", "test-bot",
-            "DelayBot" , "DelayBot is up and running")
-        database.boot_db(boot_message)
-        queue_id = None
-
-        while True:
-            delta = time.time()
-
-            # queue_id resets every 15 minutes or so
-            if queue_id == None:
-                queue_id, last_event_id = self.register()
-                # print "registered!"
-
-            dm = database.check_db(int(time.time()))
-            if dm != None:
-                msg = delaymessage.make_zulip_message(dm)
-                self.client.send_message(msg)
+    def handle_event(self, event):
+        """Responds to a single event from the Zulip event queue"""
+        if event["type"] in ("stream", "subscription"):
+            self.update_streams(event)
+            return
+        with metrics.COMMAND_SECONDS.time():
+            try:
+                self.respond(event["message"])
+            except ValueError as e:
+                self.handle_error(e, event["message"]["sender_email"])
 
-            results = self.client.get_events(
-                    queue_id=queue_id, last_event_id=last_event_id,
-                    longpolling=True, dont_block=True)
 
-            if results.get("events") == None:
-                # print results["msg"], results["result"]
-                # force queue_id to reset
-                queue_id = None
-                continue
+    def main(self, workers=4, backlog=100, processes=0, metrics_port=0, sync_interval=0):
+        """
+        Boots the database and schedule, then runs DelayBot until stopped
+        workers is how many commands can be handled at once, and backlog
+        is how many more can wait before event polling slows down
+        With no workers it only sends messages, alongside a DelayBot
+        that handles commands for the same database
+        processes hands commands to that many processes instead of
+        threads, which needs a database they can all open
+        metrics_port serves metrics for Prometheus on that port, 0 doesn't
+        sync_interval is how often, in seconds, messages other DelayBots
+        sharing the database queued or gave up on are picked up, 0 never
+        Raises a RuntimeError if processes are asked for without one,
+        or if one of them dies
+        """
 
-            for event in results["events"]:
-                last_event_id = max(last_event_id, event["id"])
-                try:
-                    self.respond(event["message"])
-                except ValueError as e:
-                    self.handle_error(e, event["message"]["sender_email"])
-                    
-            # stops the bot from running more than once per second
-            time.sleep(min(1, time.time() - delta))
+        pool = None
+        handler = None
+        if processes and workers:
+            # each process would queue messages in a store of its own,
+            # which this one never sends
+            if not database.is_shared():
+                raise RuntimeError("Command processes need a database they can all open, "
+                                    "set DATABASE_URL to a sqlite file or a database server.")
+            # forked before any database connection is opened
+            pool = shards.ShardPool(self, processes, backlog)
+            pool.start()
+            # one thread routes commands, so each user's stay in order
+            workers = 1
+            handler = pool.handle_event
+        if metrics_port:
+            # after forking, so only this process serves them
+            metrics.serve(metrics_port)
+
+        # creates or migrates the database before anything touches it
+        database.boot_db()
+        self.scheduler.load(self.read_pending())
+        bot_runtime = runtime.Runtime(self, workers, backlog, handler, sync_interval)
+        if pool is not None:
+            pool.on_failure = bot_runtime.stop
+        bot_runtime.run()
+        if pool is not None:
+            pool.close()
+            if pool.failed is not None:
+                raise RuntimeError("%s stopped, so DelayBot did too." % pool.failed)
 
 
 # blocks DelayBot from running automatically when imported
 if __name__ == "__main__":
 
     dotenv.read_dotenv()
+    logs.setup_logging("--debug" in sys.argv or None)
     zulip_username = os.environ["DELAYBOT_USR"]
     zulip_api_key = os.environ["DELAYBOT_API"]
     key_word = "DelayBot"
     # an empty list will make it subscribe to all streams
     subscribed_streams = []
-
-    new_bot = DelayBot(zulip_username, zulip_api_key, key_word, subscribed_streams)
-    new_bot.main()
\ No newline at end of file
+    # the most delayed messages sent in a single loop
+    dispatch_limit = int(os.environ.get("DELAYBOT_DISPATCH_LIMIT", 50))
+
+    # where the event queue is saved between restarts
+    state_file = os.environ.get("DELAYBOT_STATE_FILE", ".delaybot_queue.json")
+    stream_cache = os.environ.get("DELAYBOT_STREAM_CACHE", ".delaybot_streams.json")
+    # the timezone clock times are read in, defaults to New York
+    timezone = os.environ.get("DELAYBOT_TIMEZONE")
+    # threads handling commands, and how many commands can wait for them
+    # 0 only sends delayed messages, to add senders sharing the database
+    workers = int(os.environ.get("DELAYBOT_WORKERS", 4))
+    backlog = int(os.environ.get("DELAYBOT_BACKLOG", 100))
+    # processes handling commands instead, 0 keeps them in threads
+    processes = int(os.environ.get("DELAYBOT_PROCESSES", 0))
+    # how often messages other DelayBots sharing the database queued or
+    # gave up on are picked up, in seconds, 0 never, so by default only
+    # senders do, since a lone worker queues every message itself
+    sync_interval = int(os.environ.get("DELAYBOT_SYNC_INTERVAL", 0 if workers else 300))
+    # queued messages listed per page
+    page_size = int(os.environ.get("DELAYBOT_PAGE_SIZE", 20))
+    # messages sent per second on average and at once, and how long
+    # replies wait to be sent together with others to the same user
+    send_rate = float(os.environ.get("DELAYBOT_SEND_RATE", 2))
+    send_burst = int(os.environ.get("DELAYBOT_SEND_BURST", 10))
+    coalesce = float(os.environ.get("DELAYBOT_COALESCE", 0))
+    # how this DelayBot is told apart from others sharing the database,
+    # and how long messages it is sending stay claimed by it
+    worker_id = os.environ.get("DELAYBOT_WORKER_ID")
+    lease = int(os.environ.get("DELAYBOT_LEASE", 300))
+    # port metrics are served on for Prometheus, 0 turns them off
+    metrics_port = int(os.environ.get("DELAYBOT_METRICS_PORT", 0))
+    # the Zulip server, defaults to api.zulip.com
+    site = os.environ.get("DELAYBOT_SITE")
+    # seconds per tick of a timing wheel schedule, 0 keeps the default heap
+    wheel_tick = float(os.environ.get("DELAYBOT_WHEEL_TICK", 0))
+
+    new_bot = DelayBot(zulip_username, zulip_api_key, key_word, subscribed_streams,
+                        dispatch_limit, state_file, stream_cache, timezone, page_size,
+                        send_rate, send_burst, coalesce, worker_id, lease, site=site,
+                        wheel_tick=wheel_tick)
+    new_bot.main(workers, backlog, processes, metrics_port, sync_interval)
\ No newline at end of file
@@ -0,0 +1,255 @@
+#!usr/bin/python
+
+# benchmarks DelayBot's hot paths against a fake Zulip client,
+# and compares the results with a saved baseline to catch regressions
+
+from __future__ import unicode_literals
+
+import gc
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import timeit
+
+import database
+import storage
+import DelayBot
+import timeconversions as TC
+import delaymessage
+import scheduler
+import timingwheel
+
+# how much worse than the baseline a result may be before it fails
+TOLERANCE = 0.25
+# queued message counts the dispatch and queue benchmarks run at
+SIZES = (1000, 100000, 1000000)
+# users the queued messages are spread over
+USERS = 1000
+STREAM = "general"
+
+timer = timeit.default_timer
+
+
+class FakeClient(object):
+    """Accepts every Zulip call straight away, without a server"""
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, message):
+        self.sent += 1
+        return {"result": "success", "id": self.sent}
+
+    def add_subscriptions(self, streams):
+        return {"result": "success"}
+
+
+def make_bot(dispatch_limit=50):
+    """Returns a DelayBot sending to a FakeClient, without rate limits"""
+    return DelayBot.DelayBot("bench@example.com", "", "DelayBot", [STREAM],
+                dispatch_limit, send_rate=10 ** 9, send_burst=10 ** 9,
+                worker_id="bench", client=FakeClient())
+
+
+def make_command(content, sender="al@example.com", timestamp=None):
+    """Returns a private message event's message, as Zulip sends it"""
+    return {"content": content, "sender_full_name": sender, "sender_email": sender,
+            "type": "private", "timestamp": timestamp or int(time.time()),
+            "display_recipient": STREAM, "subject": "bench"}
+
+
+def percentile(samples, fraction):
+    """Returns a percentile of some sorted samples"""
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def bench_parse_time(count=20000):
+    """Parses times that miss the parse cache, and times that hit it"""
+
+    results = {}
+    now = int(time.time())
+    tz = TC.get_timezone()
+    # more distinct times than the cache holds, so each is parsed afresh
+    cold = ["%dh%dm%ds" % (i % 24 + 1, i % 60, i // 60 % 60) for i in range(count)]
+    warm = ["1h", "30m", "9am", "17:30", "8:45:59pm", "1d"] * (count // 6)
+    for name, times in (("cold", cold), ("warm", warm)):
+        start = timer()
+        for user_time in times:
+            TC.parse_time(user_time, now, tz)
+        results["parse_time.%s.ops_per_sec" % name] = len(times) / (timer() - start)
+    return results
+
+
+def bench_respond(count=2000):
+    """Times whole commands, from parsing to storing and replying"""
+
+    database.set_storage(storage.open_storage("memory://"))
+    database.boot_db()
+    bot = make_bot()
+    commands = ["DelayBot 1h %s bench hello" % STREAM, "DelayBot every 30m %s bench hi" % STREAM,
+                "DelayBot queue", "DelayBot help", "DelayBot unqueue 1"]
+    samples = []
+    for i in range(count):
+        msg = make_command(commands[i % len(commands)], "user%d@example.com" % (i % 50))
+        start = timer()
+        bot.respond(msg)
+        samples.append(timer() - start)
+
+    samples.sort()
+    results = dict(("respond.p%d_ms" % (fraction * 100), percentile(samples, fraction) * 1000)
+                    for fraction in (0.5, 0.95, 0.99))
+
+    # most stream traffic isn't for DelayBot at all
+    chatter = make_command("anyone up for lunch? " * 20)
+    chatter["type"] = "stream"
+    start = timer()
+    for i in range(count * 10):
+        bot.respond(chatter)
+    results["respond.chatter_per_sec"] = count * 10 / (timer() - start)
+    return results
+
+
+def bench_schedulers(size=200000):
+    """Times loading, pushing to, cancelling on and draining each kind of schedule"""
+
+    results = {}
+    now = time.time()
+    pending = [(now + i % 86400, i) for i in range(size)]
+    for name, make in (("heap", scheduler.Scheduler),
+                        ("wheel", lambda: timingwheel.TimingWheel(start=now))):
+        schedule = make()
+        start = timer()
+        schedule.load(pending)
+        results["schedule.%s.load_ms" % name] = (timer() - start) * 1000
+        start = timer()
+        for timestamp, message_id in pending:
+            schedule.push(timestamp + 60, message_id)
+        results["schedule.%s.pushes_per_sec" % name] = size / (timer() - start)
+        start = timer()
+        for timestamp, message_id in pending[::2]:
+            schedule.cancel(message_id)
+        results["schedule.%s.cancels_per_sec" % name] = size // 2 / (timer() - start)
+        start = timer()
+        # a day of dispatch loops, 100 at a time
+        while schedule.pop_due(now + 86400 + 61, 100):
+            pass
+        results["schedule.%s.pops_per_sec" % name] = size // 2 / (timer() - start)
+    return results
+
+
+def fill(size, now):
+    """Queues size messages spread over USERS users, all of them already due"""
+    start = timer()
+    for i in range(size):
+        database.add_message_to_db(delaymessage.DelayMessage(now - size, now - size + i,
+                "user%d@example.com" % (i % USERS), STREAM, "bench", "hello"))
+    return size / (timer() - start)
+
+
+def bench_size(size, url, batches=20):
+    """Times booting, dispatching and listing the queue with size messages queued"""
+
+    results = {}
+    now = int(time.time())
+    database.set_storage(storage.open_storage(url))
+    database.boot_db()
+    results["store.%d.inserts_per_sec" % size] = fill(size, now)
+
+    bot = make_bot()
+    start = timer()
+    bot.scheduler.load(database.get_pending())
+    results["boot.%d_ms" % size] = (timer() - start) * 1000
+
+    sender = "user%d@example.com" % (USERS - 1)
+    last_page = max(1, (size // USERS - 1) // bot.page_size + 1)
+    for name, page in (("first", 1), ("last", last_page)):
+        start = timer()
+        list(bot.queue(make_command("", sender), str(page)))
+        results["queue.%d.%s_page_ms" % (size, name)] = (timer() - start) * 1000
+
+    start = timer()
+    for i in range(batches):
+        bot.send_due_messages()
+    results["dispatch.%d.batch_ms" % size] = (timer() - start) * 1000 / batches
+    return results
+
+
+def run(sizes, url):
+    """Runs every benchmark, returning a flat dict of named results"""
+    results = {}
+    results.update(bench_parse_time())
+    results.update(bench_respond())
+    results.update(bench_schedulers())
+    for size in sizes:
+        results.update(bench_size(size, url))
+        # the next size shouldn't pay for collecting this one
+        database.set_storage(None)
+        gc.collect()
+    return results
+
+
+def is_regression(name, result, baseline, tolerance=TOLERANCE):
+    """Checks if a result is worse than its baseline by more than tolerance"""
+    if name.endswith("_per_sec"):
+        return result < baseline * (1 - tolerance)
+    return result > baseline * (1 + tolerance)
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Prints each result next to its baseline
+    Returns the names of the results that regressed
+    """
+
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            print "%-40s %12.3f" % (name, results[name])
+            continue
+        change = (results[name] - baseline[name]) / baseline[name] * 100
+        regressed = is_regression(name, results[name], baseline[name], tolerance)
+        print "%-40s %12.3f %12.3f %+8.1f%%%s" % (name, results[name], baseline[name],
+                change, "  REGRESSED" if regressed else "")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks DelayBot's hot paths.")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+            help="queued message counts to benchmark dispatch at, comma separated")
+    parser.add_argument("--storage", default="memory://",
+            help="DATABASE_URL style url of the storage to benchmark")
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+            help="fraction worse than the baseline a result may be")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    results = run(sizes, args.storage)
+    report = {"python": platform.python_version(), "storage": args.storage,
+                "time": int(time.time()), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print "%d results regressed by more than %d%%" % (
+                len(regressions), args.tolerance * 100)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
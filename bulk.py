@@ -0,0 +1,146 @@
+#!usr/bin/python
+
+# reads the lines of a bulk command, typed out or in an uploaded
+# CSV or JSON file, into delay message commands
+
+from __future__ import unicode_literals
+
+import re
+import csv
+import json
+import time
+
+# the most delay messages one bulk command can queue
+BULK_LIMIT = 1000
+# the largest uploaded file that is read, in bytes
+MAX_UPLOAD = 1024 * 1024
+# the longest an uploaded file takes to download, in seconds
+UPLOAD_TIMEOUT = 30
+# bytes read from a download at a time
+CHUNK_SIZE = 64 * 1024
+# the most line errors listed when a bulk command is rejected
+MAX_ERRORS = 10
+# columns of an uploaded file, and keys of its JSON objects
+FIELDS = ("time", "stream", "topic", "message")
+
+# how Zulip links a file uploaded in a message, ie [name.csv](/user_uploads/...)
+UPLOAD = re.compile(r"\[[^\]]*\]\((/user_uploads/[^)\s]+\.(csv|json))\)", re.IGNORECASE)
+
+
+def find_upload(line):
+    """Returns the path and format of a CSV or JSON file a line links to, or None"""
+    match = UPLOAD.search(line)
+    if match is None:
+        return None
+    return match.group(1), match.group(2).lower()
+
+
+def to_command(time, stream, topic, message):
+    """
+    Joins the fields of a file row into a command, as a private message
+    would give it, so stream and topic spaces become underscores
+    """
+    return "%s %s %s %s" % (time.strip(), stream.strip().replace(" ", "_"),
+                            topic.strip().replace(" ", "_"), message.strip())
+
+
+def read_csv(data):
+    """
+    Returns a command for each row of a CSV file's bytes, with an
+    optional header row naming FIELDS
+    Raises a ValueError if a row has the wrong number of columns
+    """
+
+    commands = []
+    for number, row in enumerate(csv.reader(data.splitlines()), 1):
+        row = [cell.decode("utf-8") for cell in row]
+        if not any(cell.strip() for cell in row):
+            continue
+        if number == 1 and [cell.strip().lower() for cell in row] == list(FIELDS):
+            continue
+        if len(row) != len(FIELDS):
+            raise ValueError("Row %d of the CSV file needs %d columns: %s." % (
+                                number, len(FIELDS), ", ".join(FIELDS)))
+        commands.append(to_command(*row))
+    return commands
+
+
+def read_json(data):
+    """
+    Returns a command for each object in a JSON file's list
+    Raises a ValueError if it isn't a list of objects with FIELDS
+    """
+
+    error = "The JSON file must be a list of objects with %s." % ", ".join(FIELDS)
+    try:
+        rows = json.loads(data.decode("utf-8"))
+    except ValueError:
+        raise ValueError(error)
+    if not isinstance(rows, list):
+        raise ValueError(error)
+    commands = []
+    for row in rows:
+        if not isinstance(row, dict) or not all(
+                isinstance(row.get(field), basestring) for field in FIELDS):
+            raise ValueError(error)
+        commands.append(to_command(*[row[field] for field in FIELDS]))
+    return commands
+
+
+def too_large():
+    """Returns the error for a file over MAX_UPLOAD"""
+    return ValueError("Uploaded files can be at most %dKB." % (MAX_UPLOAD // 1024))
+
+
+def read_download(chunks, deadline):
+    """
+    Joins the chunks of a download, giving up with a ValueError as soon
+    as they pass MAX_UPLOAD bytes, or the deadline passes
+    """
+
+    data = []
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size > MAX_UPLOAD:
+            raise too_large()
+        if time.time() > deadline:
+            raise ValueError("The uploaded file took too long to download.")
+        data.append(chunk)
+    return b"".join(data)
+
+
+def read_upload(data, kind):
+    """Returns a command for every row of an uploaded file of a kind, csv or json"""
+    if len(data) > MAX_UPLOAD:
+        raise too_large()
+    if kind == "csv":
+        return read_csv(data)
+    return read_json(data)
+
+
+def read_lines(lines, fetch):
+    """
+    Returns a command for every line of a bulk command, skipping blank ones
+    A line linking an uploaded file is replaced by that file's rows,
+    with fetch(path) returning the file's bytes
+    """
+
+    commands = []
+    for line in lines:
+        if not line.strip():
+            continue
+        upload = find_upload(line)
+        if upload is None:
+            commands.append(line.strip())
+        else:
+            commands.extend(read_upload(fetch(upload[0]), upload[1]))
+    return commands
+
+
+def describe_errors(errors):
+    """Summarizes (line number, error) pairs, listing the first MAX_ERRORS of them"""
+    listed = ["line %d: %s" % error for error in errors[:MAX_ERRORS]]
+    if len(errors) > MAX_ERRORS:
+        listed.append("and %d more" % (len(errors) - MAX_ERRORS))
+    return "\n".join(listed)
@@ -2,81 +2,184 @@
 
 # functions for interacting with the database
 
-import psycopg2
-import dataset
+import os
+import logging
 
+import storage
+import metrics
 
-def boot_db(boot_message):
-    """Write me"""
-    with dataset.connect() as db:
-        db['messages'].insert(boot_message)
+logger = logging.getLogger(__name__)
 
+# the one storage backend shared by the whole process, and its url
+_storage = None
+_url = None
 
-def get_queue(user):
-    """Write me"""
 
-    content = ""
-    with dataset.connect() as db:
-        for m in db["messages"].find(user=user, order_by="date"):
-            content += ("\t%s.\t\t  %s\t %s"
-                "\t%s|%s   ||   %s\n " % (
-                m["id"], m["dateStored"], m["date"], 
-                m["stream"], m["topic"], m["message"]))
+def get_url(url=None):
+    """
+    Returns the url connect opens, DATABASE_URL unless one is given
+    Raises a RuntimeError if neither is, memory:// has to be asked for
+    since it loses every queued message when DelayBot stops
+    """
+    url = url or os.environ.get("DATABASE_URL")
+    if not url:
+        raise RuntimeError("Set DATABASE_URL to where messages are kept, ie sqlite:///delaybot.db.")
+    return url
+
+
+def connect(url=None):
+    """
+    Opens the shared storage, defaulting to DATABASE_URL
+    See storage.open_storage for the urls it takes
+    """
+    global _storage, _url
+    _url = get_url(url)
+    _storage = storage.open_storage(_url)
+    return _storage
+
+
+def set_storage(backend):
+    """Injects an already opened storage backend, ie for tests"""
+    global _storage, _url
+    _storage = backend
+    _url = None
+
+
+def is_shared():
+    """Checks if other processes opening the storage would reach the same messages"""
+    if _storage is None:
+        return storage.is_shared(get_url())
+    return storage.is_shared(_url)
+
 
-    if not content:
-        content = "You have no messages queued."
-    else:
-        content = ("\tID.\t From Date\t\t Time\t  To Date\t\tTime"
-                    "\t\tStream|Topic\t\t||\tMessage \n" + content)
-    return content
+def get_storage():
+    """Returns the shared storage, connecting on first use"""
+    if _storage is None:
+        return connect()
+    return _storage
 
 
-def unqueue(user, del_id):
-    """Write me"""
+@metrics.timed(metrics.DB_SECONDS)
+def boot_db():
+    """
+    Brings the database schema up to date, creating it if it doesn't exist
+    Returns the schema version it is now at
+    """
+    return get_storage().boot()
 
-    dropped = 0
 
-    with dataset.connect() as db:
-        for m in db['messages'].find(user=user):
-            if m['id'] == del_id or del_id == 'ALL':
-                remove_message_from_db(m)
-                dropped += 1
+@metrics.timed(metrics.DB_SECONDS)
+def get_queue_page(user, after=None, limit=20):
+    """
+    Returns up to limit of a user's delay_messages, soonest first,
+    starting after the (timestamp, id) key of the last one already seen
+    """
+    return get_storage().queue_page(user, after, limit)
 
-    if dropped == 0:
-        return "You have nothing queued with that ID."
-    else:
-        plural = min(dropped -1, 1)
-        return "Successfully unqueued your message%s!" % ("s" * plural)
 
+@metrics.timed(metrics.DB_SECONDS)
+def get_queue_key(user, offset):
+    """
+    Returns the (timestamp, id) key of a user's delay_message at offset,
+    in the order get_queue_page lists them, or None if there isn't one
+    """
+    return get_storage().queue_key(user, offset)
 
-def check_db(unix_timestamp):
+
+def get_pending(after=0):
     """
-    Checks if any delay_messages need to be sent
-    Returns the first one found, or None
+    Yields a (timestamp, id) pair for every queued delay_message with an
+    id above after, in batches, so the schedule is built in one pass as
+    they're read
+    Used to build the in-memory schedule when DelayBot boots, and to add
+    the messages other DelayBots queued since
+    Messages leased to a worker are due again when the lease runs out
     """
+    # not timed, a generator returns before any of it is read
+    return get_storage().pending(after)
 
-    with dataset.connect() as db:
-        results = db.query("SELECT * FROM messages WHERE timestamp<%d" % unix_timestamp)
-        for result in results:
-            remove_message_from_db(result)
-            db.commit()
-            delay_message = result
-            print delay_message
-            return delay_message
-    return None
 
+@metrics.timed(metrics.DB_SECONDS)
+def get_due(until, limit=None):
+    """
+    Returns the (timestamp, id) keys of up to limit delay_messages due
+    by until that no worker holds, ie ones whose lease ran out
+    """
+    return get_storage().due(until, limit)
 
+
+@metrics.timed(metrics.DB_SECONDS)
+def unqueue(user, del_ids):
+    """
+    Removes a user's delay_messages with the given ids,
+    or all of them if del_ids is "ALL"
+    Returns the ids that were removed
+    """
+    return get_storage().unqueue(user, del_ids)
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def claim_messages(message_ids, worker, now, lease_until):
+    """
+    Leases the delay_messages with the given ids to a worker until
+    lease_until, so no other worker sends them in the meantime
+    Ids that were removed, aren't due yet or are leased to another
+    worker are skipped
+    Returns the claimed delay_messages, soonest first
+    """
+    if not message_ids:
+        return []
+    return get_storage().claim(message_ids, worker, now, lease_until)
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def renew_claims(message_ids, worker, lease_until):
+    """Extends a worker's lease on delay_messages it is still sending"""
+    if message_ids:
+        get_storage().renew(message_ids, worker, lease_until)
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def defer_messages(message_ids, worker, until):
+    """Gives up a worker's claim on delay_messages, letting any worker retry them after until"""
+    if message_ids:
+        get_storage().defer(message_ids, worker, until)
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def finish_messages(delay_messages, next_fire, worker):
+    """
+    Records in a single transaction that a worker sent delay_messages
+    next_fire(dm) gives when a message is due again, repeating messages
+    are moved to then in place and the rest are removed
+    Messages whose lease passed to another worker are left to it
+    Returns (delay_message, next timestamp or None) pairs
+    """
+    if not delay_messages:
+        return []
+    finished = [(dm, next_fire(dm)) for dm in delay_messages]
+    get_storage().finish(finished, worker)
+    return finished
+
+
+@metrics.timed(metrics.DB_SECONDS)
+def add_messages_to_db(delay_messages):
+    """
+    Adds many formatted delay_messages to the database at once
+    Returns the ids they were stored under, in the same order
+    """
+    get_storage().add_many(delay_messages)
+    logger.debug("Queued %d messages", len(delay_messages))
+    return [dm.id for dm in delay_messages]
+
+
+@metrics.timed(metrics.DB_SECONDS)
 def add_message_to_db(delay_message):
-    """Adds a formatted delay_message to the database"""
-    with dataset.connect() as db:
-        db["messages"].insert(delay_message)
-        for res in db["messages"].all():
-            print [ (x, res[x]) for x in res.keys()]
-        db.commit()
-
-
-def remove_message_from_db(result):
-    """Removes a given, existing entry from the database"""
-    with dataset.connect() as db:
-        db["messages"].delete(id=result["id"])
-        db.commit()
\ No newline at end of file
+    """
+    Adds a formatted delay_message to the database
+    Returns the id it was stored under
+    """
+    message_id = get_storage().add(delay_message)
+    logger.debug("Queued message %s for %s, due at %s", message_id,
+                    delay_message.user, delay_message.timestamp)
+    return message_id
@@ -4,30 +4,155 @@
 
 from __future__ import unicode_literals
 
+import threading
 
-def make_delay_message(dateStored, timestamp, date, user, stream, topic, message):
+import timeconversions as TC
+import recurrence
+
+# the longest private message DelayBot sends, Zulip rejects longer ones
+MAX_MESSAGE_SIZE = 10000
+
+# the most user, stream and topic names shared at once
+MAX_NAMES = 10000
+
+# one shared copy of each recent user, stream and topic name,
+# since the same few are repeated across most messages
+_names = {}
+_names_lock = threading.Lock()
+
+
+def intern_name(name):
+    """
+    Returns the shared copy of a name (intern() only takes bytes in python 2)
+    The copies are forgotten once there are MAX_NAMES of them, so names
+    that are no longer used don't stay in memory for good
+    """
+    if name is None:
+        return None
+    with _names_lock:
+        if len(_names) >= MAX_NAMES and name not in _names:
+            _names.clear()
+        return _names.setdefault(name, name)
+
+
+class DelayMessage(object):
+
+    # no per-message __dict__, these add up with a large pending set
+    __slots__ = ("id", "stored", "timestamp", "user", "stream", "topic",
+                    "message", "rule")
+
+    def __init__(self, stored, timestamp, user, stream, topic, message,
+                    rule=None, id=None):
+        """
+        A delay message keeps the unix times it was stored at and is due at,
+        the username, stream and topic to respond in, and message to send
+        rule is a stored recurrence.Rule if the message repeats
+        id is set once it has been stored in the database
+        """
+        self.id = id
+        self.stored = stored
+        self.timestamp = timestamp
+        self.user = intern_name(user)
+        self.stream = intern_name(stream)
+        self.topic = intern_name(topic)
+        self.message = message
+        self.rule = rule
+
+
+    def __repr__(self):
+        return "<DelayMessage %s due at %s>" % (self.id, self.timestamp)
+
+
+    @classmethod
+    def from_row(cls, row):
+        """Creates a delay message from a database row"""
+        return cls(row["stored"], row["timestamp"], row["user"], row["stream"],
+                    row["topic"], row["message"], row["rule"], row["id"])
+
+
+    def to_row(self):
+        """Converts a delay message into a row for the database"""
+        row = dict((name, getattr(self, name)) for name in self.__slots__)
+        if row["id"] is None:
+            del row["id"]
+        return row
+
+
+def make_delay_message(stored, timestamp, user, stream, topic, message, rule=None):
     """
     Creates an instance of a delaymessage with all data
-    it needs a date when it was stored, unix timestamp, date,
+    it needs a unix time when it was stored, unix timestamp,
     username, stream and topic to respond in, and message to send
+    and optionally the rule it repeats by
     """
-    return {
-        "dateStored": dateStored,
-        "timestamp": timestamp,
-        "date": date,
-        "user": user,
-        "stream": stream,
-        "topic": topic,
-        "message": message
-    }
+    return DelayMessage(stored, timestamp, user, stream, topic, message, rule)
+
 
+def format_stored(dm, timezone):
+    """Renders when a delay message was stored, which older ones didn't record"""
+    if dm.stored is None:
+        return "an unknown time"
+    return TC.format_time(dm.stored, timezone)
 
-def make_zulip_message(dm):
+
+def make_zulip_message(dm, timezone):
     """Converts a delaymessage into a public zulip message"""
     message = {}
     message["type"] = "stream"
-    message["to"] = dm["stream"]
-    message["subject"] = dm["topic"]
-    message["content"] = "%s\n- from @**%s** at %s (Eastern Time)" % (
-            dm["message"], dm["user"], dm["dateStored"])
-    return message
\ No newline at end of file
+    message["to"] = dm.stream
+    message["subject"] = dm.topic
+    message["content"] = "%s\n- from @**%s** at %s" % (
+            dm.message, dm.user, format_stored(dm, timezone))
+    return message
+
+
+def format_due(dm, timezone):
+    """Renders when a delay message is due next, and how it repeats"""
+    due = TC.format_time(dm.timestamp, timezone)
+    if dm.rule is None:
+        return due
+    return "%s (%s)" % (due, recurrence.describe(recurrence.load_rule(dm.rule)))
+
+
+def render_queue(dms, timezone, more):
+    """
+    Yields the lines of a queue listing for some delay messages
+    more adds a reminder that there is another page
+    """
+
+    if not dms:
+        yield "You have no messages queued."
+        return
+
+    yield ("\tID.\t From Date\t\t Time\t  To Date\t\tTime"
+            "\t\tStream|Topic\t\t||\tMessage ")
+    for dm in dms:
+        yield "\t%s.\t\t  %s\t %s\t%s|%s   ||   %s" % (
+            dm.id, format_stored(dm, timezone), format_due(dm, timezone),
+            dm.stream, dm.topic, dm.message)
+    if more:
+        yield "Send `DelayBot queue next` to see more."
+
+
+def chunk_lines(lines, size=MAX_MESSAGE_SIZE, separator="\n"):
+    """
+    Joins lines with separator into messages of at most size characters
+    Lines longer than that are split across messages
+    """
+
+    chunk = []
+    length = 0
+    for line in lines:
+        while len(line) > size:
+            if chunk:
+                yield separator.join(chunk)
+                chunk, length = [], 0
+            yield line[:size]
+            line = line[size:]
+        if chunk and length + len(separator) + len(line) > size:
+            yield separator.join(chunk)
+            chunk, length = [], 0
+        length += len(line) + (len(separator) if chunk else 0)
+        chunk.append(line)
+    if chunk:
+        yield separator.join(chunk)
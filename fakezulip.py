@@ -0,0 +1,195 @@
+#!usr/bin/python
+
+# a stand-in Zulip server for running DelayBot offline, with the
+# endpoints it calls, and a record of every message it was sent
+
+from __future__ import unicode_literals
+
+import json
+import time
+import random
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+# longest an events call waits before answering with a heartbeat, in seconds
+HEARTBEAT = 10
+
+timer = time.time
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Answers each request on its own thread, so long polls don't block sends"""
+    daemon_threads = True
+
+
+class FakeZulipHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Routes API calls to the FakeZulip the server was made for"""
+
+    # HTTP/1.1 keeps connections alive, as requests expects
+    protocol_version = "HTTP/1.1"
+    routes = {
+        ("POST", "/api/v1/register"): "register",
+        ("GET", "/api/v1/events"): "get_events",
+        ("POST", "/api/v1/messages"): "send_message",
+        ("GET", "/api/v1/streams"): "get_streams",
+        ("POST", "/api/v1/users/me/subscriptions"): "add_subscriptions",
+    }
+
+    def params(self):
+        """Returns the request's parameters, from its query or form body"""
+        url = urlparse.urlparse(self.path)
+        query = url.query
+        if self.command == "POST":
+            query = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        return dict((key, values[0].decode("utf-8"))
+                    for key, values in urlparse.parse_qs(query).items())
+
+
+    def answer(self):
+        route = self.routes.get((self.command, urlparse.urlparse(self.path).path))
+        if route is None:
+            status, results = 404, {"result": "error", "msg": "Not found"}
+        else:
+            status, results = getattr(self.server.zulip, route)(self.params())
+        body = json.dumps(results)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = answer
+    do_POST = answer
+
+
+    def log_message(self, format, *args):
+        # load tests make thousands of calls
+        pass
+
+
+class FakeZulip(object):
+
+    def __init__(self, streams=("general",), latency=0, error_rate=0, heartbeat=HEARTBEAT):
+        """
+        FakeZulip takes the streams that exist, how many seconds each
+        send takes, the fraction of sends it throttles with a retry-after,
+        and how long an events call waits for events before a heartbeat
+        Every registered queue sees every event added after it registered,
+        and like Zulip, drops the ones up to the id it is polled with
+        """
+        self.streams = list(streams)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.heartbeat = heartbeat
+        self.events = []
+        # queue id -> the last event it dropped
+        self.queues = {}
+        # (time received, message) for every message sent
+        self.sent = []
+        self.next_message_id = 1
+        self.condition = threading.Condition()
+        self.server = None
+        self.stopped = False
+
+
+    @property
+    def url(self):
+        """The site to give a zulip client, ie http://127.0.0.1:8000"""
+        return "http://%s:%d" % self.server.server_address
+
+
+    def start(self, port=0, host="127.0.0.1"):
+        """Serves the API from a daemon thread, on a free port if port is 0"""
+        self.server = ThreadingServer((host, port), FakeZulipHandler)
+        self.server.zulip = self
+        thread = threading.Thread(target=self.server.serve_forever, name="fakezulip")
+        thread.daemon = True
+        thread.start()
+        return self.url
+
+
+    def stop(self):
+        """Stops serving, answering any waiting events calls first"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def add_event(self, event):
+        """Adds an event to every queue, giving it the next event id"""
+        with self.condition:
+            event["id"] = len(self.events)
+            self.events.append(event)
+            self.condition.notify_all()
+        return event["id"]
+
+
+    def add_message(self, content, sender, private=True, stream=None, topic=None):
+        """Adds a message event, as if a user sent it now"""
+        with self.condition:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        message = {"id": message_id, "content": content, "timestamp": int(timer()),
+                    "sender_email": sender, "sender_full_name": sender,
+                    "type": "private" if private else "stream",
+                    "display_recipient": stream, "subject": topic or ""}
+        self.add_event({"type": "message", "message": message})
+        return message
+
+
+    def register(self, params):
+        with self.condition:
+            queue_id = "fake-queue-%d" % len(self.queues)
+            last_event_id = len(self.events) - 1
+            self.queues[queue_id] = last_event_id
+        return 200, {"result": "success", "queue_id": queue_id,
+                    "last_event_id": last_event_id}
+
+
+    def get_events(self, params):
+        queue_id = params.get("queue_id")
+        deadline = timer() + self.heartbeat
+        with self.condition:
+            if queue_id not in self.queues:
+                return 400, {"result": "error", "code": "BAD_EVENT_QUEUE_ID",
+                            "msg": "Bad event queue id: %s" % queue_id}
+            # dropped events can't be polled for again
+            last_event_id = max(self.queues[queue_id], int(params.get("last_event_id", -1)))
+            self.queues[queue_id] = last_event_id
+            while len(self.events) - 1 <= last_event_id and not self.stopped:
+                remaining = deadline - timer()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            events = self.events[last_event_id + 1:]
+        if not events:
+            events = [{"type": "heartbeat", "id": last_event_id}]
+        return 200, {"result": "success", "events": events}
+
+
+    def send_message(self, params):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return 429, {"result": "error", "msg": "API usage exceeded rate limit",
+                        "retry-after": 0.1, "code": "RATE_LIMIT_HIT"}
+        with self.condition:
+            self.sent.append((timer(), params))
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        return 200, {"result": "success", "id": message_id}
+
+
+    def get_streams(self, params):
+        return 200, {"result": "success", "streams": [{"name": name} for name in self.streams]}
+
+
+    def add_subscriptions(self, params):
+        names = [stream["name"] for stream in json.loads(params.get("subscriptions", "[]"))]
+        with self.condition:
+            self.streams.extend(name for name in names if name not in self.streams)
+        return 200, {"result": "success", "subscribed": {}, "already_subscribed": {}}
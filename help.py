@@ -4,8 +4,9 @@
 
 help_string = """
     Basic Commands
-        DelayBot queue --> show queued messages
-        DelayBot unqueue <id> --> unqueue message with id
+        DelayBot queue [<page>] --> show a page of queued messages
+        DelayBot queue next --> show the next page of queued messages
+        DelayBot unqueue <id> [<id>...] --> unqueue messages with ids
         DelayBot unqueue ALL  --> unqueue all messages
         DelayBot ping  --> delaybot are you there?
         DelayBot help  --> what you are reading now
@@ -20,11 +21,28 @@ help_string = """
         streams or topics with spaces need to be replaced with underscores
         ie DelayBot <time> 455_Broadway hey_everyone <message>
 
+    Delay Many Messages:
+        DelayBot bulk, then one private message style delay per line
+            DelayBot bulk
+            1h 455_Broadway hey_everyone <message>
+            daily 9am 455_Broadway standup <message>
+        or upload a CSV file with time,stream,topic,message columns,
+        or a JSON list of objects with those keys, after `DelayBot bulk`
+        nothing is delayed if any line is invalid
+
+    Repeat A Message:
+        put every, daily or weekdays before <time> in either method
+            DelayBot every <block time> <message>  --> ie every 2h
+            DelayBot daily <clock time> <message>  --> ie daily 9am
+            DelayBot weekdays <clock time> <message>  --> Monday to Friday
+        repeating messages are sent until you unqueue them
+
     Accepted <time> Formats
         block:  1h45m30s  || 1d --> now + 1hr 45mins 30sec || now + 1day
         24hr:   08:45:59  || 23:45
         12hr:   8:45:59am || 12:45pm
         single: 8am       || 12pm
         valid meridiems: am, a.m., AM, A.M.
-        note that DelayBot uses Eastern Time, as Recurse Center is in New York
+        clock times are in Eastern Time unless DelayBot was set up with another
+        timezone, as Recurse Center is in New York
 """
\ No newline at end of file
@@ -0,0 +1,220 @@
+#!usr/bin/python
+
+# load tests DelayBot.main against a fakezulip server, replaying recorded
+# or synthetic commands at a set rate, and checking every delay message
+# is sent once and on time
+
+from __future__ import unicode_literals
+
+import os
+import re
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import threading
+
+import database
+import DelayBot
+import fakezulip
+import benchmark
+
+STREAM = "general"
+TOPIC = "load"
+# how long the run waits for messages after the last one was due, in seconds
+GRACE = 10
+# how often the run checks whether every message has arrived
+POLL = 0.1
+# how long the fake server holds events calls, short so shutdowns are quick
+HEARTBEAT = 1
+# starts each synthetic delay message, so its sends can be counted
+MARKER = re.compile(r"^lt-(\d+)\b")
+
+timer = time.time
+
+
+def format_delay(seconds):
+    """Formats a delay in block format, ie 1h1m5s for 3665"""
+    parts = [(seconds // 3600, "h"), (seconds // 60 % 60, "m"), (seconds % 60, "s")]
+    return "".join("%d%s" % part for part in parts if part[0]) or "1s"
+
+
+def synthetic_commands(count, delay, users):
+    """Returns count private delay commands from users, due delay seconds after they're sent"""
+    return [{"content": "%s %s %s lt-%d" % (format_delay(delay), STREAM, TOPIC, i),
+            "sender": "user%d@example.com" % (i % users), "delay": delay}
+            for i in range(count)]
+
+
+def recorded_commands(path):
+    """
+    Reads recorded messages from a file with a JSON object per line,
+    either a message event as Zulip sends it, or just its message
+    """
+
+    commands = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            message = event.get("message", event)
+            commands.append({"content": message["content"], "sender": message["sender_email"],
+                            "private": message.get("type", "private") == "private",
+                            "stream": message.get("display_recipient"),
+                            "topic": message.get("subject")})
+    return commands
+
+
+def feed(zulip, commands, rate, due):
+    """
+    Adds commands to the fake server at rate per second, recording when
+    each synthetic delay message is due by its number
+    """
+
+    start = timer()
+    for i, command in enumerate(commands):
+        wait = start + i / rate - timer()
+        if wait > 0:
+            time.sleep(wait)
+        message = zulip.add_message(command["content"], command["sender"],
+                    command.get("private", True), command.get("stream"), command.get("topic"))
+        match = MARKER.match(command["content"].split(" ", 3)[-1])
+        if match and "delay" in command:
+            due[int(match.group(1))] = message["timestamp"] + command["delay"]
+
+
+def deliveries(zulip):
+    """Returns the times each synthetic delay message number was sent at"""
+    sent = {}
+    for received, message in list(zulip.sent):
+        match = MARKER.match(message.get("content", ""))
+        if message.get("type") == "stream" and match:
+            sent.setdefault(int(match.group(1)), []).append(received)
+    return sent
+
+
+def drive(zulip, commands, rate, due, grace):
+    """
+    Feeds every command, waits until every delay message was sent or
+    grace seconds after the last was due, then stops DelayBot.main
+    Gives up if the fake server stops first, ie DelayBot.main failed
+    """
+
+    try:
+        # commands sent before DelayBot registers would never reach it
+        while not zulip.queues:
+            if zulip.stopped:
+                return
+            time.sleep(POLL)
+        feed(zulip, commands, rate, due)
+        deadline = max(due.values() or [timer()]) + grace
+        while timer() < deadline and set(deliveries(zulip)) < set(due):
+            time.sleep(POLL)
+        # a little longer, for any duplicate sends
+        time.sleep(min(grace, 1))
+    finally:
+        # DelayBot.main stops on SIGTERM, like a deploy would stop it
+        if not zulip.stopped:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+
+def report(zulip, commands, due, started):
+    """Sums up a run, with throughput, delivery lag, and missed or duplicated sends"""
+
+    results = {"commands": len(commands)}
+    replies = [received for received, message in zulip.sent if message.get("type") == "private"]
+    if replies:
+        results["commands_per_sec"] = len(replies) / max(max(replies) - started, 1e-9)
+    results["replies"] = len(replies)
+
+    sent = deliveries(zulip)
+    results["delivered"] = sum(1 for number in due if number in sent)
+    results["missed"] = len(set(due) - set(sent))
+    results["duplicated"] = sum(len(times) - 1 for times in sent.values() if len(times) > 1)
+    lags = sorted(min(times) - due[number] for number, times in sent.items() if number in due)
+    if lags:
+        for fraction in (0.5, 0.95, 0.99):
+            results["lag.p%d_sec" % (fraction * 100)] = benchmark.percentile(lags, fraction)
+        results["lag.max_sec"] = lags[-1]
+        first = min(min(times) for times in sent.values())
+        last = max(min(times) for times in sent.values())
+        results["sends_per_sec"] = len(lags) / max(last - first, 1e-9)
+    return results
+
+
+def run(commands, rate, storage_url="memory://", workers=4, processes=0,
+        latency=0, error_rate=0, grace=GRACE):
+    """
+    Runs DelayBot.main on this thread against a fake server fed commands
+    from another, until every delay message was sent or it gives up
+    Returns the report
+    """
+
+    zulip = fakezulip.FakeZulip([STREAM], latency, error_rate, HEARTBEAT)
+    zulip.start()
+    # opened on first use, after DelayBot.main forks any shards,
+    # since a connection must never cross a fork
+    os.environ["DATABASE_URL"] = storage_url
+    database.set_storage(None)
+    bot = DelayBot.DelayBot("loadtest@example.com", "key", "DelayBot", [STREAM],
+                send_rate=10 ** 9, send_burst=10 ** 9, site=zulip.url)
+    due = {}
+    started = timer()
+    driver = threading.Thread(target=drive, args=(zulip, commands, rate, due, grace),
+                                name="driver")
+    driver.daemon = True
+    driver.start()
+    try:
+        bot.main(workers, processes=processes)
+    finally:
+        zulip.stop()
+        driver.join()
+    return report(zulip, commands, due, started)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Load tests DelayBot against a fake Zulip server.")
+    parser.add_argument("--count", type=int, default=1000, help="synthetic commands to send")
+    parser.add_argument("--rate", type=float, default=50, help="commands sent per second")
+    parser.add_argument("--delay", type=int, default=5,
+            help="seconds each synthetic delay message is due after it is sent")
+    parser.add_argument("--users", type=int, default=100, help="users sending synthetic commands")
+    parser.add_argument("--replay", help="file of recorded message events to send instead")
+    parser.add_argument("--storage", default="memory://",
+            help="DATABASE_URL style url of the storage to use")
+    parser.add_argument("--workers", type=int, default=4, help="threads handling commands")
+    parser.add_argument("--processes", type=int, default=0, help="processes handling commands")
+    parser.add_argument("--latency", type=float, default=0,
+            help="seconds the fake server takes to take each message")
+    parser.add_argument("--error-rate", type=float, default=0,
+            help="fraction of sends the fake server throttles")
+    parser.add_argument("--grace", type=float, default=GRACE,
+            help="seconds to wait for messages after the last was due")
+    parser.add_argument("--output", help="file to write the report to as JSON")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.replay:
+        commands = recorded_commands(args.replay)
+    else:
+        commands = synthetic_commands(args.count, args.delay, args.users)
+    results = run(commands, args.rate, args.storage, args.workers, args.processes,
+                    args.latency, args.error_rate, args.grace)
+    for name in sorted(results):
+        print "%-24s %12.3f" % (name, results[name])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"time": int(time.time()), "rate": args.rate, "storage": args.storage,
+                        "results": results}, f, indent=2, sort_keys=True)
+    if results["missed"] or results["duplicated"]:
+        print "%d messages were missed and %d duplicated" % (
+                results["missed"], results["duplicated"])
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
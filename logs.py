@@ -0,0 +1,30 @@
+#!usr/bin/python
+
+# sets up logging for every DelayBot module
+
+from __future__ import unicode_literals
+
+import os
+import logging
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+def is_debug():
+    """Checks the DELAYBOT_DEBUG environment variable for a truthy value"""
+    return os.environ.get("DELAYBOT_DEBUG", "").lower() in ("1", "true", "yes", "on")
+
+
+def setup_logging(debug=None):
+    """
+    Sends log records from all modules to stderr
+    debug logs everything, otherwise only INFO and up are kept
+    If debug isn't given, it is read from the environment
+    """
+
+    if debug is None:
+        debug = is_debug()
+    logging.basicConfig(format=LOG_FORMAT,
+                        level=logging.DEBUG if debug else logging.INFO)
+    # requests logs every connection it opens at INFO
+    logging.getLogger("requests").setLevel(logging.WARNING)
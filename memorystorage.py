@@ -0,0 +1,174 @@
+#!usr/bin/python
+
+# stores delay messages in this process's memory only, for tests,
+# benchmarks and throwaway instances, everything is lost when it exits
+
+from __future__ import unicode_literals
+
+import bisect
+import threading
+
+import schema
+import storage
+import delaymessage
+
+
+def copy(dm):
+    """Returns a copy of a stored delay message, so callers can't change the stored one"""
+    return delaymessage.DelayMessage.from_row(dm.to_row())
+
+
+class MemoryStorage(storage.Storage):
+
+    def __init__(self):
+        """
+        MemoryStorage keeps delay messages in dicts and sorted lists
+        Lookups by id are O(1), and due and per-user queries are a
+        binary search into lists of (timestamp, id) keys, which inserts
+        and deletes keep sorted at the cost of shifting their tails
+        """
+        self.messages = {}
+        # id -> (worker or None, lease_until) for messages with a lease
+        self.leases = {}
+        # (timestamp, id) of every message, and of every user's messages
+        self.keys = []
+        self.user_keys = {}
+        self.last_id = 0
+        self.lock = threading.RLock()
+
+
+    def index(self, dm):
+        """Adds a message's keys to the sorted lists"""
+        bisect.insort(self.keys, (dm.timestamp, dm.id))
+        bisect.insort(self.user_keys.setdefault(dm.user, []), (dm.timestamp, dm.id))
+
+
+    def unindex(self, dm):
+        """Removes a message's keys from the sorted lists"""
+        for keys in (self.keys, self.user_keys[dm.user]):
+            del keys[bisect.bisect_left(keys, (dm.timestamp, dm.id))]
+
+
+    def remove(self, message_id):
+        """Forgets a message entirely"""
+        dm = self.messages.pop(message_id)
+        self.leases.pop(message_id, None)
+        self.unindex(dm)
+
+
+    def is_leased(self, message_id, now):
+        """Checks if a message is leased past now"""
+        lease = self.leases.get(message_id)
+        return lease is not None and lease[1] > now
+
+
+    def holds(self, message_id, worker):
+        """Checks if a worker holds the claim on a message"""
+        lease = self.leases.get(message_id)
+        return lease is not None and lease[0] == worker
+
+
+    def boot(self):
+        return len(schema.MIGRATIONS)
+
+
+    def add(self, delay_message):
+        with self.lock:
+            self.last_id += 1
+            delay_message.id = self.last_id
+            self.messages[delay_message.id] = copy(delay_message)
+            self.index(delay_message)
+        return delay_message.id
+
+
+    def add_many(self, delay_messages):
+        with self.lock:
+            for dm in delay_messages:
+                self.add(dm)
+
+
+    def pending(self, after=0):
+        # a copy of the key list shares its keys, only the pairs yielded are new
+        with self.lock:
+            keys = list(self.keys)
+            leases = dict(self.leases)
+        for timestamp, message_id in keys:
+            if message_id > after:
+                yield max(timestamp, leases.get(message_id, (None, 0))[1]), message_id
+
+
+    def due(self, until, limit=None):
+        with self.lock:
+            # every key up to (until, any id)
+            end = bisect.bisect_right(self.keys, (until, float("inf")))
+            due = [key for key in self.keys[:end] if not self.is_leased(key[1], until)]
+        return due[:limit]
+
+
+    def queue_page(self, user, after=None, limit=20):
+        with self.lock:
+            keys = self.user_keys.get(user, [])
+            start = 0 if after is None else bisect.bisect_right(keys, tuple(after))
+            return [copy(self.messages[message_id])
+                    for timestamp, message_id in keys[start:start + limit]]
+
+
+    def queue_key(self, user, offset):
+        with self.lock:
+            keys = self.user_keys.get(user, [])
+            return keys[offset] if offset < len(keys) else None
+
+
+    def unqueue(self, user, del_ids):
+        with self.lock:
+            if del_ids == "ALL":
+                del_ids = [message_id for timestamp, message_id in self.user_keys.get(user, [])]
+            removed = []
+            for message_id in del_ids:
+                # an id given twice is only removed once
+                dm = self.messages.get(message_id)
+                if dm is not None and dm.user == user:
+                    self.remove(message_id)
+                    removed.append(message_id)
+        return removed
+
+
+    def claim(self, message_ids, worker, now, lease_until):
+        with self.lock:
+            claimed = []
+            for message_id in message_ids:
+                dm = self.messages.get(message_id)
+                if dm is None or dm.timestamp > now or self.is_leased(message_id, now):
+                    continue
+                self.leases[message_id] = (worker, lease_until)
+                claimed.append(copy(dm))
+        return sorted(claimed, key=lambda dm: (dm.timestamp, dm.id))
+
+
+    def renew(self, message_ids, worker, lease_until):
+        with self.lock:
+            for message_id in message_ids:
+                if self.holds(message_id, worker):
+                    self.leases[message_id] = (worker, lease_until)
+
+
+    def defer(self, message_ids, worker, until):
+        with self.lock:
+            for message_id in message_ids:
+                if self.holds(message_id, worker):
+                    self.leases[message_id] = (None, until)
+
+
+    def finish(self, finished, worker):
+        with self.lock:
+            for dm, next_timestamp in finished:
+                if not self.holds(dm.id, worker):
+                    continue
+                if next_timestamp is None:
+                    self.remove(dm.id)
+                    continue
+                stored = self.messages[dm.id]
+                self.unindex(stored)
+                stored.timestamp = next_timestamp
+                self.index(stored)
+                del self.leases[dm.id]
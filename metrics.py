@@ -0,0 +1,269 @@
+#!usr/bin/python
+
+# counters and latency histograms for DelayBot's hot paths, served in
+# Prometheus's text format, and costing one check each while disabled
+
+from __future__ import unicode_literals
+
+import os
+import abc
+import bisect
+import logging
+import functools
+import threading
+import contextlib
+import timeit
+import BaseHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# buckets for calls that should take milliseconds, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# buckets for how late delayed messages go out, in seconds
+LAG_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 3600)
+
+# address metrics are served on, only this machine by default
+HOST = os.environ.get("DELAYBOT_METRICS_HOST", "127.0.0.1")
+
+timer = timeit.default_timer
+
+# nothing is recorded until enable() is called
+_enabled = False
+# every metric, in the order they are served
+_metrics = []
+
+
+def enable(enabled=True):
+    """Starts recording metrics, or stops if enabled is False"""
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled():
+    return _enabled
+
+
+def format_value(value):
+    """Formats a sample value, dropping the decimals of whole numbers"""
+    if value == int(value):
+        return "%d" % value
+    return "%r" % value
+
+
+class Metric(object):
+
+    __metaclass__ = abc.ABCMeta
+
+    kind = None
+
+    def __init__(self, name, description, label=None):
+        """
+        Metric takes a Prometheus name, a description, and optionally the
+        name of a label its samples are split by, ie "call"
+        """
+        self.name = name
+        self.description = description
+        self.label = label
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+
+    def labels(self, value, extra=None):
+        """Formats a sample's labels, from its label value and any extra ones"""
+        pairs = []
+        if self.label is not None:
+            pairs.append("%s=\"%s\"" % (self.label, value))
+        if extra:
+            pairs.append(extra)
+        return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+    @abc.abstractmethod
+    def samples(self):
+        """Yields a line for each of the metric's samples"""
+
+
+    def render(self):
+        """Returns the metric in Prometheus's text format"""
+        lines = ["# HELP %s %s" % (self.name, self.description),
+                "# TYPE %s %s" % (self.name, self.kind)]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+
+    kind = "counter"
+
+    def __init__(self, name, description, label=None):
+        Metric.__init__(self, name, description, label)
+        # label value -> total
+        self.values = {}
+
+
+    def inc(self, value=None, amount=1):
+        """Adds amount to the total for a label value"""
+        if not _enabled:
+            return
+        with self.lock:
+            self.values[value] = self.values.get(value, 0) + amount
+
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for value, total in values:
+            yield "%s%s %s" % (self.name, self.labels(value), format_value(total))
+
+
+class Gauge(Metric):
+
+    kind = "gauge"
+
+    def __init__(self, name, description):
+        """Gauge reads its value from a function whenever it is served"""
+        Metric.__init__(self, name, description)
+        self.function = None
+
+
+    def set_function(self, function):
+        self.function = function
+
+
+    def samples(self):
+        if self.function is not None:
+            yield "%s %s" % (self.name, format_value(self.function()))
+
+
+class Histogram(Metric):
+
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS, label=None):
+        """Histogram counts observations into buckets of upper bounds"""
+        Metric.__init__(self, name, description, label)
+        self.buckets = tuple(buckets)
+        # label value -> [count per bucket, with one past the last for +Inf, sum]
+        self.values = {}
+
+
+    def observe(self, amount, value=None):
+        """Records an observation for a label value"""
+        if not _enabled:
+            return
+        index = bisect.bisect_left(self.buckets, amount)
+        with self.lock:
+            counts = self.values.get(value)
+            if counts is None:
+                counts = self.values[value] = [[0] * (len(self.buckets) + 1), 0]
+            counts[0][index] += 1
+            counts[1] += amount
+
+
+    @contextlib.contextmanager
+    def time(self, value=None):
+        """Observes how long the block inside it takes"""
+        if not _enabled:
+            yield
+            return
+        start = timer()
+        try:
+            yield
+        finally:
+            self.observe(timer() - start, value)
+
+
+    def samples(self):
+        with self.lock:
+            values = sorted((value, (list(counts[0]), counts[1]))
+                            for value, counts in self.values.items())
+        for value, (counts, total) in values:
+            # buckets are cumulative in the text format
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bound = bound if bound == "+Inf" else format_value(bound)
+                yield "%s_bucket%s %d" % (self.name,
+                        self.labels(value, "le=\"%s\"" % bound), cumulative)
+            yield "%s_sum%s %s" % (self.name, self.labels(value), format_value(total))
+            yield "%s_count%s %d" % (self.name, self.labels(value), cumulative)
+
+
+def timed(histogram):
+    """Decorates a function to observe how long its calls take, labelled by its name"""
+
+    def decorator(function):
+        name = function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(timer() - start, name)
+        return wrapper
+    return decorator
+
+
+def render():
+    """Returns every metric in Prometheus's text format"""
+    return "".join(metric.render() + "\n" for metric in _metrics)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers GET /metrics with every metric"""
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        # every scrape would otherwise be written to stderr
+        logger.debug(format, *args)
+
+
+def serve(port, host=HOST):
+    """
+    Starts recording metrics, and serves them at http://host:port/metrics
+    from a daemon thread
+    Returns the server, whose shutdown() stops it
+    """
+
+    enable()
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, server.server_port)
+    return server
+
+
+# the metrics DelayBot records
+DELIVERY_LAG = Histogram("delaybot_delivery_lag_seconds",
+        "Seconds between when delay messages were due and when they were sent.",
+        LAG_BUCKETS)
+COMMAND_SECONDS = Histogram("delaybot_command_seconds",
+        "Seconds taken to handle each command, replies included.")
+DB_SECONDS = Histogram("delaybot_db_call_seconds",
+        "Seconds taken by database calls.", label="call")
+API_SECONDS = Histogram("delaybot_api_call_seconds",
+        "Seconds taken by Zulip API calls.", label="call")
+MESSAGES_SENT = Counter("delaybot_messages_sent_total",
+        "Delay messages and replies sent, by how Zulip took them.", label="status")
+REGISTRATIONS = Counter("delaybot_registrations_total",
+        "Event queues registered, including after the last one expired.")
+SCHEDULED = Gauge("delaybot_scheduled_messages",
+        "Delay messages scheduled in this process.")
+BACKLOG = Gauge("delaybot_command_backlog",
+        "Commands waiting for a worker.")
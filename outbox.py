@@ -0,0 +1,203 @@
+#!usr/bin/python
+
+# sends DelayBot's outgoing Zulip messages under a rate limit,
+# retrying ones that fail and optionally coalescing replies
+
+from __future__ import unicode_literals
+
+import time
+import random
+import logging
+import threading
+
+import delaymessage
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# attempts after the first, and the backoff between them in seconds
+RETRIES = 5
+RETRY_BASE = 1
+RETRY_CAP = 60
+# how long a message that couldn't be sent waits to be tried again
+DEFER_DELAY = 60
+
+# what send() did with a message
+SENT = "sent"
+# Zulip refused it, and would again
+REJECTED = "rejected"
+# it may still go through, so should be tried again later
+DEFERRED = "deferred"
+
+# results the zulip client makes up when no response came back
+CLIENT_ERRORS = ("connection-error", "unexpected-error", "http-error")
+
+
+def is_retryable(results):
+    """Checks if a failed send_message call might succeed if tried again"""
+    return (results.get("result") in CLIENT_ERRORS or
+            "retry-after" in results or results.get("code") == "RATE_LIMIT_HIT")
+
+
+def retry_delay(results, attempt):
+    """
+    Returns how long to wait before trying a failed send again
+    Zulip says how long when it throttles, otherwise it backs off
+    """
+    if results.get("retry-after") is not None:
+        return float(results["retry-after"])
+    return random.uniform(0, min(RETRY_CAP, RETRY_BASE * 2 ** attempt))
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst, clock=time.time):
+        """
+        TokenBucket allows rate sends per second on average,
+        and up to burst of them at once after a quiet spell
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+
+    def refill(self, now):
+        """Adds the tokens earned since the bucket was last updated"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def take(self):
+        """
+        Takes a token, returning 0, if there is one
+        Otherwise returns how many seconds until there will be
+        """
+        with self.lock:
+            now = self.clock()
+            # updated is in the future while the bucket is held
+            if now > self.updated:
+                self.refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate + max(0, self.updated - now)
+
+
+    def hold(self, seconds):
+        """Empties the bucket, and stops it refilling for seconds"""
+        with self.lock:
+            self.tokens = 0
+            self.updated = max(self.updated, self.clock() + seconds)
+
+
+class Outbox(object):
+
+    def __init__(self, client, rate=2, burst=10, coalesce=0):
+        """
+        Outbox takes a Zulip client, the messages per second it may
+        send on average and in a burst, and how many seconds to hold
+        replies for so several to the same user go out as one (0 for never)
+        """
+        self.client = client
+        self.bucket = TokenBucket(rate, burst)
+        self.coalesce = coalesce
+        self.stopping = threading.Event()
+        # user -> replies waiting to be sent, and the timer that sends them
+        self.pending = {}
+        self.timers = {}
+        self.lock = threading.Lock()
+
+
+    def wait_for_token(self):
+        """Waits until the rate limit allows a send, False if stopped first"""
+        while not self.stopping.is_set():
+            delay = self.bucket.take()
+            if delay <= 0:
+                return True
+            self.stopping.wait(delay)
+        return False
+
+
+    def send(self, message):
+        """
+        Sends a message, retrying while Zulip might still take it
+        Returns SENT, REJECTED or DEFERRED
+        """
+        status = self.deliver(message)
+        metrics.MESSAGES_SENT.inc(status)
+        return status
+
+
+    def deliver(self, message):
+        """Makes every attempt at sending a message, for send()"""
+
+        for attempt in range(RETRIES + 1):
+            if not self.wait_for_token():
+                return DEFERRED
+            with metrics.API_SECONDS.time("send_message"):
+                results = self.client.send_message(message)
+            if results.get("result") == "success":
+                return SENT
+            if not is_retryable(results):
+                logger.warning("Zulip rejected a message to %s (%s)",
+                                message["to"], results.get("msg"))
+                return REJECTED
+
+            delay = retry_delay(results, attempt)
+            logger.warning("Failed to send a message to %s (%s: %s), "
+                            "retrying in %.1f seconds", message["to"],
+                            results.get("result"), results.get("msg"), delay)
+            if "retry-after" in results:
+                # every other send is throttled too
+                self.bucket.hold(delay)
+            else:
+                self.stopping.wait(delay)
+
+        return DEFERRED
+
+
+    def reply(self, to, content):
+        """Sends a private message, after any others to them being coalesced"""
+
+        if not self.coalesce:
+            self.send_replies(to, [content])
+            return
+        with self.lock:
+            self.pending.setdefault(to, []).append(content)
+            if to in self.timers:
+                return
+            timer = threading.Timer(self.coalesce, self.flush, [to])
+            timer.daemon = True
+            self.timers[to] = timer
+        timer.start()
+
+
+    def flush(self, to):
+        """Sends every reply waiting for a user"""
+        with self.lock:
+            contents = self.pending.pop(to, [])
+            self.timers.pop(to, None)
+        self.send_replies(to, contents)
+
+
+    def send_replies(self, to, contents):
+        """Sends replies to a user in as few messages as fit"""
+        for content in delaymessage.chunk_lines(contents, separator="\n\n"):
+            status = self.send({"type": "private", "to": to, "content": content})
+            if status != SENT:
+                logger.warning("Gave up on a reply to %s", to)
+
+
+    def close(self):
+        """Sends the replies still being coalesced, then stops every send"""
+        with self.lock:
+            timers = self.timers.values()
+            self.timers = {}
+        for timer in timers:
+            timer.cancel()
+        for to in self.pending.keys():
+            self.flush(to)
+        self.stopping.set()
@@ -0,0 +1,100 @@
+#!usr/bin/python
+
+# rules for delay messages that repeat, and when they fire next
+
+from __future__ import unicode_literals
+
+import datetime
+import collections
+
+import timeconversions as TC
+
+# every: a block time interval, ie every 30m
+# daily: a clock time each day, ie daily 9am
+# weekdays: a clock time Monday to Friday, ie weekdays 9:30am
+KINDS = ("every", "daily", "weekdays")
+
+# stops a repeating message from flooding a stream
+MIN_INTERVAL = TC.MINUTE
+
+# seconds is the interval for "every" rules, and the time of day
+# (in seconds after midnight) for "daily" and "weekdays" rules
+Rule = collections.namedtuple("Rule", "kind seconds")
+
+
+def parse_rule(kind, user_time):
+    """Returns a Rule from a kind and a time, raising a ValueError on invalid input"""
+
+    parsed = TC.get_time(user_time)
+    if kind == "every":
+        if parsed.format != "block":
+            raise ValueError("`every` needs a block time, like 30m or 2h.")
+        seconds = TC.block_seconds(parsed)
+        if seconds < MIN_INTERVAL:
+            raise ValueError("Messages can only repeat once a minute at most.")
+    else:
+        if parsed.format == "block":
+            raise ValueError("`%s` needs a clock time, like 9am or 17:30." % kind)
+        seconds = TC.clock_hour(parsed) * TC.HOUR + parsed.M * TC.MINUTE + parsed.S
+
+    return Rule(kind, seconds)
+
+
+def format_rule(rule):
+    """Converts a Rule into text for the database"""
+    return "%s %d" % rule
+
+
+def load_rule(text):
+    """Converts text from the database back into a Rule"""
+    kind, seconds = text.split(" ")
+    return Rule(kind, int(seconds))
+
+
+def describe(rule):
+    """Renders a Rule for people to read"""
+    if rule.kind == "every":
+        hours, rest = divmod(rule.seconds, TC.HOUR)
+        minutes, seconds = divmod(rest, TC.MINUTE)
+        parts = ["%d%s" % (value, unit) for value, unit in
+                    ((hours, "h"), (minutes, "m"), (seconds, "s")) if value]
+        return "every %s" % "".join(parts)
+    hours, rest = divmod(rule.seconds, TC.HOUR)
+    minutes, seconds = divmod(rest, TC.MINUTE)
+    return "%s at %02d:%02d:%02d" % (rule.kind, hours, minutes, seconds)
+
+
+def next_clock_time(rule, after, timezone):
+    """Returns the first unix time after after that a clock Rule fires at"""
+
+    hours, rest = divmod(rule.seconds, TC.HOUR)
+    minutes, seconds = divmod(rest, TC.MINUTE)
+    day = datetime.datetime.fromtimestamp(after, timezone).date()
+    while True:
+        if rule.kind == "daily" or day.weekday() < 5:
+            fire = TC.localize(timezone, day, hours, minutes, seconds)
+            if fire > after:
+                return fire
+        day += datetime.timedelta(days=1)
+
+
+def first_fire(rule, zulip_time, timezone):
+    """Returns when a new Rule first fires, counting from when it was sent"""
+    if rule.kind == "every":
+        return zulip_time + rule.seconds
+    return next_clock_time(rule, zulip_time, timezone)
+
+
+def next_fire(rule, previous, now, timezone):
+    """
+    Returns when a Rule fires next, counting on from when it last fired
+    Any times missed before now (ie while DelayBot was down) are skipped
+    """
+
+    if rule.kind == "every":
+        fire = previous + rule.seconds
+        if fire <= now:
+            missed = (now - previous) // rule.seconds
+            fire = previous + (missed + 1) * rule.seconds
+        return fire
+    return next_clock_time(rule, max(previous, now), timezone)
@@ -0,0 +1,163 @@
+#!usr/bin/python
+
+# keeps DelayBot registered with a Zulip event queue across outages and restarts
+
+from __future__ import unicode_literals
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+
+import wakeup
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# backoff between failed attempts, in seconds
+BACKOFF_BASE = 1
+BACKOFF_CAP = 300
+# how often the last handled event is saved, at most, in seconds
+SAVE_INTERVAL = 1
+
+
+def is_queue_expired(results):
+    """Checks if a failed get_events call means the queue is gone for good"""
+    return (results.get("code") == "BAD_EVENT_QUEUE_ID" or
+            results.get("msg", "").startswith("Bad event queue id"))
+
+
+class Registration(object):
+
+    def __init__(self, client, event_types, state_file=None, stopping=None):
+        """
+        Registration takes a Zulip client, the event types to register for,
+        an optional file to persist the queue in so restarts can resume it,
+        and an optional threading.Event that stops backoffs, with wake()
+        Only handled events are acknowledged, to Zulip by polling after
+        them and to the file, so a restart gets every event that was
+        taken but not handled again
+        """
+        self.client = client
+        self.event_types = event_types
+        self.state_file = state_file
+        self.stopping = stopping or threading.Event()
+        self.wakeup = wakeup.Wakeup()
+        self.failures = 0
+        self.queue_id = None
+        # the last event taken from the queue, and the last one handled
+        self.last_event_id = None
+        self.acked = None
+        # when the file was last written
+        self.saved = 0
+        self.load()
+
+
+    def load(self):
+        """Resumes the queue saved by a previous run, if there is one"""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            self.queue_id = state["queue_id"]
+            self.last_event_id = self.acked = state["last_event_id"]
+            logger.info("Resuming queue %s after event %s",
+                        self.queue_id, self.last_event_id)
+        except (IOError, ValueError, KeyError):
+            logger.warning("Ignoring unreadable queue state in %s", self.state_file)
+
+
+    def save(self):
+        """Persists the queue, replacing the old file in one step"""
+        if not self.state_file:
+            return
+        self.saved = time.time()
+        temp_file = self.state_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump({"queue_id": self.queue_id,
+                        "last_event_id": self.acked}, f)
+        os.rename(temp_file, self.state_file)
+
+
+    def backoff(self):
+        """Sleeps for an exponentially growing, randomly jittered time"""
+        self.failures += 1
+        ceiling = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (self.failures - 1))
+        delay = random.uniform(0, ceiling)
+        logger.debug("Backing off for %.1f seconds", delay)
+        self.wakeup.wait(delay)
+
+
+    def wake(self):
+        """Cuts a backoff short, ie once stopping is set"""
+        self.wakeup.wake()
+
+
+    def queue(self):
+        """
+        Returns queue_id and the last event handled, registering a new
+        queue first if there isn't one, and backing off while that fails
+        Zulip drops every event up to the id get_events is called with,
+        so it is called with this one
+        Returns None for both if stopped before that succeeded
+        """
+
+        while self.queue_id is None and not self.stopping.is_set():
+            with metrics.API_SECONDS.time("register"):
+                registration = self.client.register(json.dumps(self.event_types))
+            if registration.get("queue_id") is None:
+                logger.warning("Failed to register (%s: %s)",
+                        registration.get("result"), registration.get("msg"))
+                self.backoff()
+                continue
+
+            self.queue_id = registration["queue_id"]
+            self.last_event_id = self.acked = registration["last_event_id"]
+            self.failures = 0
+            self.save()
+            metrics.REGISTRATIONS.inc()
+            logger.info("Registered with queue %s", self.queue_id)
+
+        return self.queue_id, self.acked
+
+
+    def take(self, last_event_id):
+        """Records that every event up to last_event_id has been taken"""
+        self.failures = 0
+        self.last_event_id = last_event_id
+
+
+    def ack(self, event_id):
+        """
+        Records that every event up to event_id has been handled, which
+        is where polling and restarts resume the queue from
+        It is saved every SAVE_INTERVAL at most, and by save()
+        Returns True if that is further than before
+        """
+        if event_id == self.acked:
+            return False
+        self.acked = event_id
+        if time.time() - self.saved >= SAVE_INTERVAL:
+            self.save()
+        return True
+
+
+    def fail(self, results):
+        """
+        Handles a failed get_events call
+        Expired queues are dropped so the next queue() registers a new one,
+        other failures keep the queue and back off before trying again
+        """
+
+        if is_queue_expired(results):
+            logger.warning("Event queue %s expired", self.queue_id)
+            self.queue_id = None
+            self.last_event_id = self.acked = None
+            self.save()
+        else:
+            logger.warning("Failed to get events (%s: %s)",
+                            results.get("result"), results.get("msg"))
+            self.backoff()
@@ -0,0 +1,178 @@
+#!usr/bin/python
+
+# routes messages to DelayBot's command handlers, turning away chatter
+# that doesn't start with its key word before looking at any more of it
+
+from __future__ import unicode_literals
+
+import re
+
+# a whitespace separated term, so runs of spaces and newlines are one gap
+TERM = re.compile(r"\S+", re.UNICODE)
+
+
+class Terms(object):
+
+    def __init__(self, content, offset=0):
+        """
+        Terms reads a message's terms one at a time from offset, only as
+        far as a command needs, instead of splitting the whole message
+        """
+        self.content = content
+        self.offset = offset
+
+
+    def next(self):
+        """Returns the next term, or None at the end of the message"""
+        match = TERM.search(self.content, self.offset)
+        if match is None:
+            return None
+        self.offset = match.end()
+        return match.group()
+
+
+    def rest(self):
+        """Returns every term left"""
+        terms = TERM.findall(self.content, self.offset)
+        self.offset = len(self.content)
+        return terms
+
+
+    def body(self):
+        """
+        Returns the rest of the message as it was written, newlines, code
+        blocks and all, from its next term on, or None if nothing is left
+        """
+        match = TERM.search(self.content, self.offset)
+        if match is None:
+            return None
+        self.offset = len(self.content)
+        return self.content[match.start():]
+
+
+class Arg(object):
+
+    def __init__(self, name, convert=None, optional=False):
+        """
+        Arg is a single term a command takes, passed to its handler as name
+        convert turns the term into the value passed, raising a ValueError
+        if it's invalid, and optional args are left out when missing
+        """
+        self.name = name
+        self.convert = convert
+        self.optional = optional
+
+
+    def take(self, terms):
+        """Returns the arg's part of the terms left, or None if it's missing"""
+        return terms.next()
+
+
+    def read(self, terms):
+        value = self.take(terms)
+        if value is None or self.convert is None:
+            return value
+        return self.convert(value)
+
+
+class Rest(Arg):
+    """Every term left, as a list"""
+
+    def take(self, terms):
+        return terms.rest() or None
+
+
+class Body(Arg):
+    """The rest of the message as it was written"""
+
+    def take(self, terms):
+        return terms.body()
+
+
+class Command(object):
+
+    def __init__(self, name, handler, args=(), private_args=None, missing=None,
+                    private_missing=None, defaults=None):
+        """
+        Command takes its name, a handler called with the message and its
+        args by name, and the Args it takes from public messages and from
+        private ones, which are the same unless given
+        missing and private_missing are the errors when a required arg
+        isn't given, and defaults are passed to the handler with the args
+        """
+        self.name = name
+        self.handler = handler
+        self.args = tuple(args)
+        self.private_args = self.args if private_args is None else tuple(private_args)
+        self.missing = missing or "`%s` needs more than that." % name
+        self.private_missing = private_missing or self.missing
+        self.defaults = defaults or {}
+
+
+    def parse(self, terms, private):
+        """Returns the handler's keyword arguments, read from the terms left"""
+        values = dict(self.defaults)
+        for arg in self.private_args if private else self.args:
+            value = arg.read(terms)
+            if value is None:
+                if arg.optional:
+                    continue
+                raise ValueError(self.private_missing if private else self.missing)
+            values[arg.name] = value
+        return values
+
+
+class Router(object):
+
+    def __init__(self, key_word):
+        """
+        Router takes the key word public messages must start with to be
+        for DelayBot (case insensitive), which private ones may leave out
+        """
+        # the key word anywhere in the first term, ie @**DelayBot**
+        self.prefix = re.compile(r"\s*\S*?%s\S*" % re.escape(key_word),
+                                re.IGNORECASE | re.UNICODE)
+        self.commands = {}
+        self.default = None
+
+
+    def add(self, name, handler, args=(), private_args=None, missing=None,
+            private_missing=None, defaults=None):
+        """
+        Registers a command, see Command
+        A name of None makes it the command used when the first term
+        isn't the name of another, and reads its args from that term on
+        """
+        command = Command(name, handler, args, private_args, missing,
+                            private_missing, defaults)
+        if name is None:
+            self.default = command
+        else:
+            self.commands[name] = command
+        return command
+
+
+    def route(self, content, private):
+        """
+        Finds the command a message is calling, and reads its args
+        Returns (command, args), or None if the message isn't for DelayBot
+        Raises a ValueError if the command is missing or invalid
+        """
+
+        match = self.prefix.match(content)
+        if match is not None:
+            offset = match.end()
+        elif private:
+            offset = 0
+        else:
+            return None
+
+        terms = Terms(content, offset)
+        word = terms.next()
+        if word is None:
+            raise ValueError("You must specify a command when calling me.")
+        command = self.commands.get(word.lower())
+        if command is None:
+            command = self.default
+            terms.offset = offset
+        return command, command.parse(terms, private)
@@ -0,0 +1,230 @@
+#!usr/bin/python
+
+# runs DelayBot's event polling, message dispatch and command handling
+# on separate threads, so one slow Zulip call can't hold up the others
+
+from __future__ import unicode_literals
+
+import time
+import Queue
+import signal
+import logging
+import threading
+
+import wakeup
+import metrics
+import registration
+
+logger = logging.getLogger(__name__)
+
+# longest the dispatcher sleeps when nothing is scheduled, it is
+# woken early by new messages and by shutdowns
+DISPATCH_WAKE = 60
+# how often a blocked thread checks for a shutdown
+STOP_CHECK = 0.5
+# how long join() waits for each thread to finish its current work
+JOIN_TIMEOUT = 10
+# longest the poller waits for a command to be handled, before polling
+# again when the last poll only returned events it already had
+ACK_WAIT = 1
+
+
+class Runtime(object):
+
+    def __init__(self, bot, workers=4, backlog=100, handler=None, sync_interval=0):
+        """
+        Runtime takes a booted DelayBot, the number of threads that
+        handle commands, and how many events may wait for one of them
+        When the backlog is full, event polling waits for it to drain
+        handler is called with each event instead of bot.handle_event
+        sync_interval is how often the bot's schedule is synced with the
+        database, in seconds, 0 never
+        """
+        self.bot = bot
+        self.workers = workers
+        self.sync_interval = sync_interval
+        self.handler = handler or bot.handle_event
+        self.events = Queue.Queue(maxsize=backlog)
+        self.stopping = threading.Event()
+        self.threads = []
+        self.registration = registration.Registration(bot.client,
+                bot.event_types, bot.state_file, self.stopping)
+        # ids of events taken from the queue but not handled yet, the
+        # queue is only acknowledged up to the first of them
+        self.unhandled = set()
+        self.acking = threading.Lock()
+        # woken when events are acknowledged
+        self.acked = wakeup.Wakeup()
+        metrics.SCHEDULED.set_function(lambda: len(bot.scheduler))
+        metrics.BACKLOG.set_function(self.events.qsize)
+
+
+    def start(self):
+        """
+        Starts the dispatcher, and the poller and every command worker
+        if there are any workers
+        """
+
+        targets = [("dispatcher", self.dispatch)]
+        if self.workers:
+            targets.append(("poller", self.poll_events))
+        for i in range(self.workers):
+            targets.append(("worker-%d" % i, self.handle_events))
+
+        for name, target in targets:
+            thread = threading.Thread(target=self.guard, args=(target,), name=name)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+
+    def guard(self, target):
+        """Runs a thread's loop, stopping everything if it dies"""
+        try:
+            target()
+        except Exception:
+            logger.exception("%s crashed", threading.current_thread().name)
+            self.stopping.set()
+
+
+    def poll_events(self):
+        """Feeds events from the Zulip event queue to the command workers"""
+
+        polled_queue_id = None
+        while not self.stopping.is_set():
+            queue_id, acked = self.registration.queue()
+            if queue_id is None:
+                return
+            if queue_id != polled_queue_id:
+                # a new queue numbers its events from scratch
+                with self.acking:
+                    self.unhandled.clear()
+                polled_queue_id = queue_id
+
+            # blocks until Zulip has events, or sends a heartbeat, and
+            # returns events taken but not yet handled again
+            with metrics.API_SECONDS.time("get_events"):
+                results = self.bot.client.get_events(
+                        queue_id=queue_id, last_event_id=acked)
+
+            if results.get("events") is None:
+                self.registration.fail(results)
+                continue
+
+            with self.acking:
+                taken = self.registration.last_event_id
+                fresh = [event for event in results["events"] if event["id"] > taken]
+                self.registration.take(max([taken] + [event["id"] for event in fresh]))
+                # heartbeats only keep the long poll alive
+                events = [event for event in fresh if event["type"] != "heartbeat"]
+                self.unhandled.update(event["id"] for event in events)
+                waiting = not fresh and self.unhandled
+            for event in events:
+                self.put_event((queue_id, event))
+            self.acknowledge(queue_id)
+            if waiting:
+                # polling again straight away would only get the same events
+                self.acked.wait(ACK_WAIT)
+
+
+    def acknowledge(self, queue_id, event_id=None):
+        """
+        Marks an event handled, and acknowledges every event before the
+        oldest one still unhandled, so a restart takes that one again
+        Events handled out of order may be taken again too, so commands
+        are handled at least once, and rarely twice
+        """
+        with self.acking:
+            # events of an expired queue are still handled, but not acknowledged
+            if queue_id != self.registration.queue_id:
+                return
+            self.unhandled.discard(event_id)
+            if self.unhandled:
+                advanced = self.registration.ack(min(self.unhandled) - 1)
+            else:
+                advanced = self.registration.ack(self.registration.last_event_id)
+        if advanced:
+            self.acked.wake()
+
+
+    def put_event(self, item):
+        """Waits for room in the backlog, unless shutting down"""
+        while not self.stopping.is_set():
+            try:
+                self.events.put(item, timeout=STOP_CHECK)
+                return
+            except Queue.Full:
+                logger.debug("Command backlog is full, waiting")
+
+
+    def dispatch(self):
+        """Sends delayed messages as soon as they are due"""
+        synced = time.time()
+        wake = min(DISPATCH_WAKE, self.sync_interval or DISPATCH_WAKE)
+        while not self.stopping.is_set():
+            self.bot.scheduler.wait(wake)
+            if self.stopping.is_set():
+                return
+            if self.sync_interval and time.time() - synced >= self.sync_interval:
+                self.bot.sync_schedule()
+                synced = time.time()
+            self.bot.send_due_messages()
+
+
+    def handle_events(self):
+        """Handles commands from the backlog until told to stop"""
+        while True:
+            item = self.events.get()
+            # None is put once per worker by join()
+            if item is None:
+                return
+            queue_id, event = item
+            try:
+                self.handler(event)
+            except Exception:
+                logger.exception("Failed to handle event %s", event.get("id"))
+            # failed commands aren't retried, they would only fail again
+            self.acknowledge(queue_id, event.get("id"))
+
+
+    def stop(self, *args):
+        """
+        Tells every thread to stop after what it is currently doing
+        Can be used directly as a signal handler
+        """
+        if not self.stopping.is_set():
+            logger.info("Shutting down")
+        self.stopping.set()
+        self.bot.scheduler.wake()
+        self.registration.wake()
+        self.acked.wake()
+
+
+    def join(self):
+        """Lets the workers finish the backlog, then waits for every thread"""
+        for i in range(self.workers):
+            # workers exit when they reach these, after the rest of the backlog
+            self.events.put(None)
+        for thread in self.threads:
+            # the poller may be stuck waiting on Zulip, but it is a daemon
+            thread.join(JOIN_TIMEOUT)
+        # replies still held for coalescing go out last
+        self.bot.outbox.close()
+        # acknowledgements since the last save
+        with self.acking:
+            if self.registration.queue_id is not None:
+                self.registration.save()
+
+
+    def run(self):
+        """Starts every thread, and blocks until SIGINT, SIGTERM or a crash"""
+
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        self.start()
+        # sleeps rather than waiting on the event, which polls in python 2,
+        # and so signals still reach the main thread
+        while not self.stopping.is_set():
+            time.sleep(STOP_CHECK)
+        self.stop()
+        self.join()
@@ -0,0 +1,147 @@
+#!usr/bin/python
+
+# in-memory schedule of when queued delay messages are due
+
+from __future__ import unicode_literals
+
+import time
+import heapq
+import itertools
+import threading
+
+import wakeup
+
+# pairs merge() applies each time it takes the lock
+MERGE_BATCH = 1000
+
+
+class Scheduler(object):
+
+    def __init__(self):
+        """
+        Keeps a min-heap of (timestamp, id) pairs for every pending
+        delay message, so the bot only touches the database when
+        something is actually due
+        Safe to share between threads, and wait() can be used to
+        sleep until the next message is due
+        """
+        self.heap = []
+        # id -> timestamp of every live entry, stale heap entries are
+        # skipped lazily when they reach the top
+        self.entries = {}
+        self.lock = threading.RLock()
+        # wait() sleeps on this, which unlike a timed Condition.wait in
+        # python 2 doesn't poll
+        self.wakeup = wakeup.Wakeup()
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def load(self, pending):
+        """Replaces the schedule with the given (timestamp, id) pairs"""
+        with self.lock:
+            self.entries = dict((message_id, timestamp) for timestamp, message_id in pending)
+            self.heap = [(timestamp, message_id) for message_id, timestamp in self.entries.items()]
+            heapq.heapify(self.heap)
+        self.wake()
+
+
+    def merge(self, pending):
+        """
+        Schedules (timestamp, id) pairs read from the database,
+        keeping the later time for messages already scheduled
+        pending is read MERGE_BATCH pairs at a time outside the lock,
+        so pushes and cancels don't wait on the database meanwhile
+        """
+        pending = iter(pending)
+        while True:
+            batch = list(itertools.islice(pending, MERGE_BATCH))
+            if not batch:
+                break
+            with self.lock:
+                self._merge(batch)
+        self.wake()
+
+
+    def _merge(self, batch):
+        """Applies a batch of merge(), with the lock held"""
+        for timestamp, message_id in batch:
+            if timestamp > self.entries.get(message_id, -1):
+                self.entries[message_id] = timestamp
+                heapq.heappush(self.heap, (timestamp, message_id))
+
+
+    def push(self, timestamp, message_id):
+        """Schedules (or reschedules) a message to be due at timestamp"""
+        with self.lock:
+            self.entries[message_id] = timestamp
+            heapq.heappush(self.heap, (timestamp, message_id))
+            # anything waiting may now have an earlier deadline
+            if self.heap[0] != (timestamp, message_id):
+                return
+        self.wake()
+
+
+    def cancel(self, message_id):
+        """Forgets a message, returns False if it was not scheduled"""
+        with self.lock:
+            return self.entries.pop(message_id, None) is not None
+
+
+    def _discard_stale(self):
+        """Drops cancelled or rescheduled entries from the top of the heap"""
+        while self.heap:
+            timestamp, message_id = self.heap[0]
+            if self.entries.get(message_id) == timestamp:
+                return
+            heapq.heappop(self.heap)
+
+
+    def next_deadline(self):
+        """Returns the timestamp of the earliest pending message, or None"""
+        with self.lock:
+            self._discard_stale()
+            if not self.heap:
+                return None
+            return self.heap[0][0]
+
+
+    def seconds_until_next(self, now, default):
+        """Returns how long until the next message is due, capped at default"""
+        deadline = self.next_deadline()
+        if deadline is None:
+            return default
+        return max(0, min(default, deadline - now))
+
+
+    def wait(self, timeout):
+        """
+        Sleeps until the next message is due, a sooner one is pushed,
+        wake() is called, or timeout seconds pass
+        Meant for a single waiting thread
+        """
+        self.wakeup.wait(self.seconds_until_next(time.time(), timeout))
+
+
+    def wake(self):
+        """Wakes up the thread in wait(), ie when shutting down"""
+        self.wakeup.wake()
+
+
+    def pop_due(self, now, limit=None):
+        """
+        Removes and returns the ids of messages due before now, soonest first
+        At most limit ids are returned, the rest stay scheduled
+        """
+        due = []
+        with self.lock:
+            while limit is None or len(due) < limit:
+                self._discard_stale()
+                if not self.heap or self.heap[0][0] >= now:
+                    break
+                timestamp, message_id = heapq.heappop(self.heap)
+                del self.entries[message_id]
+                due.append(message_id)
+        return due
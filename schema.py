@@ -0,0 +1,132 @@
+#!usr/bin/python
+
+# explicit database schema, and the migrations that bring a database up to it
+
+from __future__ import unicode_literals
+
+from sqlalchemy import MetaData, Table, Column, inspect
+from sqlalchemy import Integer, BigInteger, UnicodeText
+
+metadata = MetaData()
+
+messages = Table("messages", metadata,
+    Column("id", Integer, primary_key=True),
+    # unix times the message was stored at, and is due at
+    Column("stored", BigInteger),
+    Column("timestamp", BigInteger, nullable=False),
+    # readable dates written by older versions, no longer used
+    Column("dateStored", UnicodeText),
+    Column("date", UnicodeText),
+    Column("user", UnicodeText, nullable=False),
+    Column("stream", UnicodeText, nullable=False),
+    Column("topic", UnicodeText, nullable=False),
+    Column("message", UnicodeText, nullable=False),
+    # a stored recurrence.Rule, for messages that repeat
+    Column("rule", UnicodeText),
+    # the worker sending the message, and the unix time until which
+    # no other worker may claim it
+    Column("claimed_by", UnicodeText),
+    Column("lease_until", BigInteger),
+)
+
+# the single row in here is the last migration that was applied
+schema_version = Table("schema_version", metadata,
+    Column("version", Integer, nullable=False),
+)
+
+
+def add_column(connection, table, column, sql_type):
+    """Adds a column to a table, unless it was created with it"""
+    columns = [c["name"] for c in inspect(connection).get_columns(table)]
+    if column not in columns:
+        connection.execute("ALTER TABLE %s ADD COLUMN \"%s\" %s" % (
+                            table, column, sql_type))
+
+
+def create_messages(connection):
+    """Creates the messages table, unless dataset already made one"""
+    messages.create(connection, checkfirst=True)
+
+
+def fix_timestamp_type(connection):
+    """
+    Tables made by older versions of DelayBot had their column types
+    guessed by dataset, which stored timestamps as floats
+    """
+    if connection.dialect.name == "postgresql":
+        connection.execute("ALTER TABLE messages ALTER COLUMN timestamp "
+                            "TYPE BIGINT USING timestamp::bigint")
+
+
+def index_messages(connection):
+    """Indexes due message lookup and per-user queue listing"""
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_messages_timestamp "
+                        "ON messages (timestamp)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_messages_user_date "
+                        "ON messages (\"user\", date)")
+
+
+def add_stored(connection):
+    """Stores when a message was queued as a unix time, not a date string"""
+    add_column(connection, "messages", "stored", "BIGINT")
+
+
+def add_rule(connection):
+    """Lets messages repeat, instead of being deleted once sent"""
+    add_column(connection, "messages", "rule", "TEXT")
+
+
+def index_queue(connection):
+    """
+    Lets queue listings page through a user's messages in due order
+    from the index alone, date is no longer written so its index goes
+    """
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_messages_user_timestamp "
+                        "ON messages (\"user\", timestamp, id)")
+    connection.execute("DROP INDEX IF EXISTS ix_messages_user_date")
+
+
+def add_claims(connection):
+    """Lets several DelayBot workers share the database without double sending"""
+    add_column(connection, "messages", "claimed_by", "TEXT")
+    add_column(connection, "messages", "lease_until", "BIGINT")
+
+
+# applied in order, a migration's version is its position in this list + 1
+# never reorder or remove these, only append new ones
+MIGRATIONS = [
+    create_messages,
+    fix_timestamp_type,
+    index_messages,
+    add_stored,
+    add_rule,
+    index_queue,
+    add_claims,
+]
+
+
+def get_version(connection):
+    """Returns the last migration applied to a database, 0 if none were"""
+    schema_version.create(connection, checkfirst=True)
+    version = connection.execute(schema_version.select()).scalar()
+    return version or 0
+
+
+def migrate(engine):
+    """
+    Applies every migration a SQLAlchemy engine's database hasn't had yet,
+    each in its own transaction along with its version bump
+    Returns the version the database is now at
+    """
+
+    with engine.connect() as connection:
+        version = get_version(connection)
+        for i, migration in enumerate(MIGRATIONS[version:], version + 1):
+            with connection.begin():
+                migration(connection)
+                if version == 0:
+                    connection.execute(schema_version.insert(), version=i)
+                else:
+                    connection.execute(schema_version.update(), version=i)
+            version = i
+    return version
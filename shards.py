@@ -0,0 +1,191 @@
+#!usr/bin/python
+
+# hands commands out to worker processes, so handling them scales across cores
+# every command from one user goes to the same process, in the order it came
+
+from __future__ import unicode_literals
+
+import zlib
+import Queue
+import signal
+import logging
+import threading
+import multiprocessing
+
+import outbox
+import streams
+
+logger = logging.getLogger(__name__)
+
+# how many commands can wait for each process before routing blocks
+PROCESS_BACKLOG = 100
+# how long close() waits for each process to finish its backlog
+JOIN_TIMEOUT = 10
+# how often routing checks that a shard it is waiting on is still running
+ALIVE_CHECK = 1
+
+
+def shard_for(key, count):
+    """Picks a shard for a key, the same one in every process and run"""
+    # hash() of a string isn't stable across runs if hash randomization is on
+    return (zlib.crc32(key.encode("utf-8")) & 0xffffffff) % count
+
+
+class SchedulerProxy(object):
+
+    def __init__(self, updates):
+        """
+        SchedulerProxy stands in for the coordinator's Scheduler
+        in a shard process, sending the changes back over a queue
+        """
+        self.updates = updates
+
+
+    def push(self, timestamp, message_id):
+        """Schedules (or reschedules) a message in the coordinator"""
+        self.updates.put(("push", timestamp, message_id))
+
+
+    def cancel(self, message_id):
+        """Forgets a message in the coordinator"""
+        self.updates.put(("cancel", message_id))
+
+
+def run_shard(bot, events, updates, send_share):
+    """Handles the commands routed to one shard process until told to stop"""
+
+    # the coordinator decides when shards stop, and tells them in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    bot.scheduler = SchedulerProxy(updates)
+    # only the coordinator writes the stream cache
+    registry = streams.StreamRegistry()
+    registry.names = set(bot.streams.names)
+    bot.streams = registry
+    bot.outbox = share_outbox(bot.outbox, send_share)
+
+    while True:
+        event = events.get()
+        if event is None:
+            break
+        try:
+            if event["type"] in ("stream", "subscription"):
+                bot.streams.apply_event(event)
+            else:
+                bot.handle_event(event)
+        except Exception:
+            logger.exception("Failed to handle event %s", event.get("id"))
+    bot.outbox.close()
+
+
+def share_outbox(box, share):
+    """Returns a new Outbox with a share of another's rate limit"""
+    return outbox.Outbox(box.client, box.bucket.rate * share,
+                    max(1, int(box.bucket.burst * share)), box.coalesce)
+
+
+class ShardPool(object):
+
+    def __init__(self, bot, processes, backlog=PROCESS_BACKLOG):
+        """
+        ShardPool takes a DelayBot and how many processes to handle its
+        commands in, which are forked from it by start()
+        The DelayBot keeps polling events and sending delayed messages,
+        and the processes share its send rate limit with it evenly
+        on_failure is called if a shard process dies, ie to stop the
+        runtime so a supervisor restarts DelayBot
+        """
+        self.bot = bot
+        self.events = [multiprocessing.Queue(backlog) for i in range(processes)]
+        # scheduler changes the shards made, applied here by a thread
+        self.updates = multiprocessing.Queue()
+        self.processes = []
+        self.updater = None
+        self.on_failure = None
+        # the name of the first shard process found dead
+        self.failed = None
+
+
+    def start(self):
+        """
+        Forks every shard process
+        Must run before the database is connected to, so no process
+        inherits another's connections
+        """
+
+        share = 1.0 / (len(self.events) + 1)
+        for i, events in enumerate(self.events):
+            process = multiprocessing.Process(target=run_shard, name="shard-%d" % i,
+                    args=(self.bot, events, self.updates, share))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        self.bot.outbox = share_outbox(self.bot.outbox, share)
+
+        self.updater = threading.Thread(target=self.apply_updates, name="shard-updates")
+        self.updater.daemon = True
+        self.updater.start()
+
+
+    def apply_updates(self):
+        """Applies the shards' scheduler changes until close() puts None"""
+        while True:
+            update = self.updates.get()
+            if update is None:
+                return
+            if update[0] == "push":
+                self.bot.scheduler.push(update[1], update[2])
+            else:
+                self.bot.scheduler.cancel(update[1])
+
+
+    def put(self, shard, event):
+        """
+        Adds an event to a shard's backlog, waiting while it is full
+        Raises a RuntimeError if the shard process died, after calling
+        on_failure, since its backlog would never drain
+        """
+
+        process = self.processes[shard]
+        while process.is_alive():
+            try:
+                self.events[shard].put(event, timeout=ALIVE_CHECK)
+                return
+            except Queue.Full:
+                continue
+        if self.failed is None:
+            self.failed = process.name
+            logger.error("%s exited with code %s", process.name, process.exitcode)
+            if self.on_failure is not None:
+                self.on_failure()
+        raise RuntimeError("%s isn't running" % process.name)
+
+
+    def handle_event(self, event):
+        """
+        Routes a command to the shard for its sender, blocking while that
+        shard's backlog is full, and stream changes to every shard
+        """
+
+        if event["type"] in ("stream", "subscription"):
+            self.bot.update_streams(event)
+            for shard in range(len(self.events)):
+                self.put(shard, event)
+            return
+        sender = event["message"]["sender_email"]
+        self.put(shard_for(sender, len(self.events)), event)
+
+
+    def close(self):
+        """Lets every running shard finish its backlog, then stops them"""
+        for events, process in zip(self.events, self.processes):
+            try:
+                if process.is_alive():
+                    events.put(None, timeout=JOIN_TIMEOUT)
+            except Queue.Full:
+                logger.warning("%s didn't drain its backlog", process.name)
+        for process in self.processes:
+            process.join(JOIN_TIMEOUT)
+        self.updates.put(None)
+        if self.updater is not None:
+            self.updater.join(JOIN_TIMEOUT)
@@ -0,0 +1,202 @@
+#!usr/bin/python
+
+# stores delay messages in a sqlite file through the standard library,
+# for small deployments and local runs without a database server
+
+from __future__ import unicode_literals
+
+import sqlite3
+import threading
+import contextlib
+
+import sqlalchemy
+from sqlalchemy.pool import StaticPool
+
+import schema
+import storage
+import delaymessage
+
+# seconds a write waits for another process's write to finish
+BUSY_TIMEOUT = 30
+# compiled statements kept per connection, more than there are below
+STATEMENT_CACHE = 64
+
+# every statement is a constant string, so sqlite3 compiles each once
+# and reuses it from its statement cache from then on
+COLUMNS = "id, stored, timestamp, \"user\", stream, topic, message, rule"
+INSERT = ("INSERT INTO messages (stored, timestamp, \"user\", stream, topic, message, rule) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)")
+SELECT = "SELECT %s FROM messages WHERE id = ?" % COLUMNS
+PENDING = ("SELECT id, timestamp, lease_until FROM messages "
+            "WHERE id > ? ORDER BY id LIMIT ?")
+DUE = ("SELECT timestamp, id FROM messages "
+        "WHERE timestamp <= ? AND (lease_until IS NULL OR lease_until <= ?) "
+        "ORDER BY timestamp, id LIMIT ?")
+QUEUE_FIRST = ("SELECT %s FROM messages WHERE \"user\" = ? "
+                "ORDER BY timestamp, id LIMIT ?" % COLUMNS)
+QUEUE_AFTER = ("SELECT %s FROM messages WHERE \"user\" = ? "
+                "AND (timestamp > ? OR (timestamp = ? AND id > ?)) "
+                "ORDER BY timestamp, id LIMIT ?" % COLUMNS)
+QUEUE_KEY = ("SELECT timestamp, id FROM messages WHERE \"user\" = ? "
+                "ORDER BY timestamp, id LIMIT 1 OFFSET ?")
+USER_IDS = "SELECT id FROM messages WHERE \"user\" = ?"
+DELETE_USER = "DELETE FROM messages WHERE \"user\" = ?"
+DELETE_OWN = "DELETE FROM messages WHERE id = ? AND \"user\" = ?"
+CLAIM = ("UPDATE messages SET claimed_by = ?, lease_until = ? "
+            "WHERE id = ? AND timestamp <= ? AND (lease_until IS NULL OR lease_until <= ?)")
+RENEW = "UPDATE messages SET lease_until = ? WHERE id = ? AND claimed_by = ?"
+DEFER = "UPDATE messages SET claimed_by = NULL, lease_until = ? WHERE id = ? AND claimed_by = ?"
+DELETE_CLAIMED = "DELETE FROM messages WHERE id = ? AND claimed_by = ?"
+RESCHEDULE = ("UPDATE messages SET timestamp = ?, claimed_by = NULL, lease_until = NULL "
+                "WHERE id = ? AND claimed_by = ?")
+
+
+def dict_row(cursor, row):
+    """Row factory for dicts, since sqlite3.Row won't take unicode keys in python 2"""
+    return dict((column[0], value) for column, value in zip(cursor.description, row))
+
+
+class SqliteStorage(storage.Storage):
+
+    def __init__(self, path):
+        """
+        SqliteStorage keeps delay messages in the sqlite file at path,
+        or in memory for ":memory:"
+        Calls cost microseconds rather than round trips, so claims and
+        deletes run one cheap statement per id inside a single transaction
+        """
+        self.path = path
+        # one connection shared by every thread, since sqlite only
+        # writes one transaction at a time anyway
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT,
+                isolation_level=None, check_same_thread=False,
+                cached_statements=STATEMENT_CACHE)
+        self.connection.row_factory = dict_row
+        self.lock = threading.RLock()
+        if path != ":memory:":
+            # readers, ie other DelayBot processes, and the writer don't block each other
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # WAL stays consistent without syncing on every commit
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Yields the connection inside a write transaction that commits on exit"""
+        with self.lock:
+            # takes the write lock up front, so it can't fail half way through
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+
+    def read(self, statement, *args):
+        """Returns every row a read-only statement selects"""
+        with self.lock:
+            return self.connection.execute(statement, args).fetchall()
+
+
+    def boot(self):
+        # the migrations are written for SQLAlchemy, so lend it this connection
+        engine = sqlalchemy.create_engine("sqlite://", poolclass=StaticPool,
+                                            creator=lambda: self.connection)
+        with self.lock:
+            # SQLAlchemy expects the rows sqlite3 makes by default
+            self.connection.row_factory = None
+            try:
+                return schema.migrate(engine)
+            finally:
+                self.connection.row_factory = dict_row
+
+
+    def add(self, delay_message):
+        dm = delay_message
+        with self.transaction() as connection:
+            dm.id = connection.execute(INSERT, (dm.stored, dm.timestamp, dm.user,
+                    dm.stream, dm.topic, dm.message, dm.rule)).lastrowid
+        return dm.id
+
+
+    def add_many(self, delay_messages):
+        # a statement per row costs no round trips here, only the commit counts
+        with self.transaction() as connection:
+            for dm in delay_messages:
+                dm.id = connection.execute(INSERT, (dm.stored, dm.timestamp, dm.user,
+                        dm.stream, dm.topic, dm.message, dm.rule)).lastrowid
+
+
+    def pending(self, after=0):
+        # batches are keyed by id, so no cursor is left open between them
+        while True:
+            rows = self.read(PENDING, after, storage.PENDING_BATCH)
+            for row in rows:
+                yield max(row["timestamp"], row["lease_until"] or 0), row["id"]
+            if len(rows) < storage.PENDING_BATCH:
+                return
+            after = rows[-1]["id"]
+
+
+    def due(self, until, limit=None):
+        # a negative limit is no limit to sqlite
+        return [(row["timestamp"], row["id"]) for row in
+                self.read(DUE, until, until, -1 if limit is None else limit)]
+
+
+    def queue_page(self, user, after=None, limit=20):
+        if after is None:
+            rows = self.read(QUEUE_FIRST, user, limit)
+        else:
+            timestamp, message_id = after
+            rows = self.read(QUEUE_AFTER, user, timestamp, timestamp, message_id, limit)
+        return [delaymessage.DelayMessage.from_row(row) for row in rows]
+
+
+    def queue_key(self, user, offset):
+        rows = self.read(QUEUE_KEY, user, offset)
+        if not rows:
+            return None
+        return rows[0]["timestamp"], rows[0]["id"]
+
+
+    def unqueue(self, user, del_ids):
+        with self.transaction() as connection:
+            if del_ids == "ALL":
+                removed = [row["id"] for row in connection.execute(USER_IDS, (user,))]
+                connection.execute(DELETE_USER, (user,))
+                return removed
+            return [message_id for message_id in del_ids
+                    if connection.execute(DELETE_OWN, (message_id, user)).rowcount]
+
+
+    def claim(self, message_ids, worker, now, lease_until):
+        with self.transaction() as connection:
+            claimed = [delaymessage.DelayMessage.from_row(
+                        connection.execute(SELECT, (message_id,)).fetchone())
+                        for message_id in message_ids
+                        if connection.execute(CLAIM, (worker, lease_until,
+                                message_id, now, now)).rowcount]
+        return sorted(claimed, key=lambda dm: (dm.timestamp, dm.id))
+
+
+    def renew(self, message_ids, worker, lease_until):
+        with self.transaction() as connection:
+            connection.executemany(RENEW, [(lease_until, message_id, worker)
+                                            for message_id in message_ids])
+
+
+    def defer(self, message_ids, worker, until):
+        with self.transaction() as connection:
+            connection.executemany(DEFER, [(until, message_id, worker)
+                                            for message_id in message_ids])
+
+
+    def finish(self, finished, worker):
+        with self.transaction() as connection:
+            connection.executemany(DELETE_CLAIMED, [(dm.id, worker)
+                    for dm, next_timestamp in finished if next_timestamp is None])
+            connection.executemany(RESCHEDULE, [(next_timestamp, dm.id, worker)
+                    for dm, next_timestamp in finished if next_timestamp is not None])
@@ -0,0 +1,278 @@
+#!usr/bin/python
+
+# stores delay messages in a server database like postgres, through dataset
+
+import os
+import logging
+import functools
+import threading
+import contextlib
+
+import psycopg2
+import dataset
+import sqlalchemy.exc
+from sqlalchemy import select, and_, or_, bindparam
+from sqlalchemy.pool import QueuePool
+
+import schema
+import storage
+import delaymessage
+
+logger = logging.getLogger(__name__)
+
+# connection pool settings for server databases, overridable from the env
+POOL_SIZE = int(os.environ.get("DELAYBOT_DB_POOL_SIZE", 5))
+POOL_RECYCLE = int(os.environ.get("DELAYBOT_DB_POOL_RECYCLE", 300))
+# times a call is retried after its connection was dropped
+RECONNECT_ATTEMPTS = 1
+# rows in each multi-row insert, well under postgres's parameter limit
+INSERT_BATCH = 1000
+
+
+def reconnecting(method):
+    """
+    Retries a database call if it failed because the connection dropped
+    The dead connection is invalidated, so the retry gets a fresh one
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        # a nested call can't retry half of its outer transaction
+        if getattr(self.local, "depth", 0):
+            return method(self, *args, **kwargs)
+        for attempt in range(RECONNECT_ATTEMPTS + 1):
+            try:
+                return method(self, *args, **kwargs)
+            except sqlalchemy.exc.DBAPIError as e:
+                if not e.connection_invalidated or attempt == RECONNECT_ATTEMPTS:
+                    raise
+                logger.warning("Lost the database connection, retrying %s",
+                                method.__name__)
+    return wrapper
+
+
+def after_key(key):
+    """Where clause for messages ordered after a (timestamp, id) key"""
+    messages = schema.messages
+    timestamp, message_id = key
+    return or_(messages.c.timestamp > timestamp,
+                and_(messages.c.timestamp == timestamp, messages.c.id > message_id))
+
+
+class SqlStorage(storage.Storage):
+
+    def __init__(self, url):
+        """
+        SqlStorage keeps delay messages in any database SQLAlchemy can
+        reach at url, built for postgres where several DelayBots share one
+        Round trips dominate, so every call is a single transaction of a
+        few set-based statements, over a pool of long-lived connections
+        """
+        engine_kwargs = {}
+        if not url.startswith("sqlite"):
+            # dataset would otherwise open a new connection per transaction
+            engine_kwargs = {"poolclass": QueuePool, "pool_size": POOL_SIZE,
+                            "pool_recycle": POOL_RECYCLE}
+        self.db = dataset.connect(url, engine_kwargs=engine_kwargs)
+        # tracks whether the current thread is already inside a transaction
+        self.local = threading.local()
+
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Yields the dataset database inside a transaction that commits on exit
+        Nested calls join the outermost transaction instead of starting their own
+        """
+
+        if getattr(self.local, "depth", 0):
+            yield self.db
+            return
+
+        self.local.depth = 1
+        try:
+            with self.db:
+                yield self.db
+        finally:
+            self.local.depth = 0
+
+
+    @reconnecting
+    def boot(self):
+        version = schema.migrate(self.db.engine)
+        # dataset reflected the old schema when it connected
+        self.db.update_table(schema.messages.name)
+        return version
+
+
+    @reconnecting
+    def add(self, delay_message):
+        with self.transaction() as db:
+            delay_message.id = db["messages"].insert(delay_message.to_row(), ensure=False)
+        return delay_message.id
+
+
+    @reconnecting
+    def add_many(self, delay_messages):
+        messages = schema.messages
+        with self.transaction() as db:
+            if db.engine.dialect.name != "postgresql":
+                for dm in delay_messages:
+                    dm.id = db["messages"].insert(dm.to_row(), ensure=False)
+                return
+            for start in range(0, len(delay_messages), INSERT_BATCH):
+                batch = delay_messages[start:start + INSERT_BATCH]
+                # postgres returns the ids in the order the rows were given
+                results = db.executable.execute(messages.insert()
+                        .values([dm.to_row() for dm in batch]).returning(messages.c.id))
+                for dm, result in zip(batch, results):
+                    dm.id = result["id"]
+
+
+    def pending(self, after=0):
+        # batches are keyed by id, so no connection is held between them
+        while True:
+            rows = self.pending_batch(after)
+            for row in rows:
+                yield max(row["timestamp"], row["lease_until"] or 0), row["id"]
+            if len(rows) < storage.PENDING_BATCH:
+                return
+            after = rows[-1]["id"]
+
+
+    @reconnecting
+    def pending_batch(self, after):
+        """Returns the next PENDING_BATCH rows pending() reads, by id after after"""
+        messages = schema.messages
+        query = (select([messages.c.id, messages.c.timestamp, messages.c.lease_until])
+                    .where(messages.c.id > after)
+                    .order_by(messages.c.id).limit(storage.PENDING_BATCH))
+        with self.transaction() as db:
+            return db.executable.execute(query).fetchall()
+
+
+    @reconnecting
+    def due(self, until, limit=None):
+        messages = schema.messages
+        query = (select([messages.c.timestamp, messages.c.id])
+                    .where(and_(messages.c.timestamp <= until,
+                                or_(messages.c.lease_until == None,
+                                    messages.c.lease_until <= until)))
+                    .order_by(messages.c.timestamp, messages.c.id).limit(limit))
+        with self.transaction() as db:
+            return [(row["timestamp"], row["id"]) for row in db.executable.execute(query)]
+
+
+    @reconnecting
+    def queue_page(self, user, after=None, limit=20):
+        messages = schema.messages
+        where = messages.c.user == user
+        if after is not None:
+            where = and_(where, after_key(after))
+        query = (select([messages]).where(where)
+                    .order_by(messages.c.timestamp, messages.c.id).limit(limit))
+        with self.transaction() as db:
+            return [delaymessage.DelayMessage.from_row(row)
+                    for row in db.executable.execute(query)]
+
+
+    @reconnecting
+    def queue_key(self, user, offset):
+        messages = schema.messages
+        query = (select([messages.c.timestamp, messages.c.id])
+                    .where(messages.c.user == user)
+                    .order_by(messages.c.timestamp, messages.c.id)
+                    .offset(offset).limit(1))
+        with self.transaction() as db:
+            row = db.executable.execute(query).first()
+        if row is None:
+            return None
+        return row["timestamp"], row["id"]
+
+
+    def delete_returning_ids(self, db, where):
+        """
+        Deletes every message matching a where clause in one statement
+        Returns the ids of the deleted messages
+        """
+
+        messages = schema.messages
+        if db.engine.dialect.name == "postgresql":
+            results = db.executable.execute(
+                messages.delete().where(where).returning(messages.c.id))
+            return [result["id"] for result in results]
+
+        # sqlite has no RETURNING, so find them inside the same transaction
+        results = db.executable.execute(select([messages.c.id]).where(where))
+        message_ids = [result["id"] for result in results]
+        if message_ids:
+            db.executable.execute(
+                messages.delete().where(messages.c.id.in_(message_ids)))
+        return message_ids
+
+
+    @reconnecting
+    def unqueue(self, user, del_ids):
+        where = schema.messages.c.user == user
+        if del_ids != "ALL":
+            where = and_(where, schema.messages.c.id.in_(del_ids))
+        with self.transaction() as db:
+            return self.delete_returning_ids(db, where)
+
+
+    @reconnecting
+    def claim(self, message_ids, worker, now, lease_until):
+        messages = schema.messages
+        claimable = and_(messages.c.id.in_(message_ids), messages.c.timestamp <= now,
+                        or_(messages.c.lease_until == None, messages.c.lease_until <= now))
+        with self.transaction() as db:
+            if db.engine.dialect.name == "postgresql":
+                # rows another worker is claiming right now are skipped, not waited on
+                query = select([messages.c.id]).where(claimable).with_for_update(skip_locked=True)
+                claimable = messages.c.id.in_([row["id"] for row in db.executable.execute(query)])
+            # sqlite writes one transaction at a time, so the update alone is enough
+            db.executable.execute(messages.update().where(claimable)
+                                    .values(claimed_by=worker, lease_until=lease_until))
+            query = (select([messages])
+                        .where(and_(messages.c.id.in_(message_ids),
+                                    messages.c.claimed_by == worker,
+                                    messages.c.lease_until == lease_until))
+                        .order_by(messages.c.timestamp))
+            return [delaymessage.DelayMessage.from_row(row)
+                    for row in db.executable.execute(query)]
+
+
+    @reconnecting
+    def renew(self, message_ids, worker, lease_until):
+        messages = schema.messages
+        with self.transaction() as db:
+            db.executable.execute(messages.update()
+                    .where(and_(messages.c.id.in_(message_ids), messages.c.claimed_by == worker))
+                    .values(lease_until=lease_until))
+
+
+    @reconnecting
+    def defer(self, message_ids, worker, until):
+        messages = schema.messages
+        with self.transaction() as db:
+            db.executable.execute(messages.update()
+                    .where(and_(messages.c.id.in_(message_ids), messages.c.claimed_by == worker))
+                    .values(claimed_by=None, lease_until=until))
+
+
+    @reconnecting
+    def finish(self, finished, worker):
+        messages = schema.messages
+        with self.transaction() as db:
+            done = [dm.id for dm, next_timestamp in finished if next_timestamp is None]
+            if done:
+                db.executable.execute(messages.delete().where(
+                        and_(messages.c.id.in_(done), messages.c.claimed_by == worker)))
+            repeats = [{"_id": dm.id, "_timestamp": next_timestamp}
+                        for dm, next_timestamp in finished if next_timestamp is not None]
+            if repeats:
+                db.executable.execute(messages.update()
+                        .where(and_(messages.c.id == bindparam("_id"),
+                                    messages.c.claimed_by == worker))
+                        .values(timestamp=bindparam("_timestamp"),
+                                claimed_by=None, lease_until=None), repeats)
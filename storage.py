@@ -0,0 +1,139 @@
+#!usr/bin/python
+
+# the interface every place DelayBot stores delay messages in provides,
+# and picking one from a database url
+
+from __future__ import unicode_literals
+
+import abc
+
+# rows pending() reads from a database at a time
+PENDING_BATCH = 10000
+
+
+class Storage(object):
+    """
+    Stores delay messages by id, and answers the queries DelayBot needs
+    Every method is safe to call from several threads at once
+    Keys are (timestamp, id) pairs, which is the order messages are due in
+    A backend missing any method can't be created
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def boot(self):
+        """
+        Prepares the storage for use, ie creating or migrating tables
+        Returns the schema version it is now at
+        """
+
+
+    @abc.abstractmethod
+    def add(self, delay_message):
+        """Stores a new delay_message, sets its id and returns it"""
+
+
+    @abc.abstractmethod
+    def add_many(self, delay_messages):
+        """Stores new delay_messages all at once, setting their ids"""
+
+
+    @abc.abstractmethod
+    def pending(self, after=0):
+        """
+        Yields a (timestamp, id) pair for every stored delay_message with
+        an id above after, reading PENDING_BATCH rows at a time so they're
+        never all held
+        Messages leased to a worker are due again when the lease runs out
+        """
+
+
+    @abc.abstractmethod
+    def due(self, until, limit=None):
+        """Returns the keys of up to limit messages due by until, soonest first"""
+
+
+    @abc.abstractmethod
+    def queue_page(self, user, after=None, limit=20):
+        """
+        Returns up to limit of a user's delay_messages, soonest first,
+        starting after the key of the last one already seen
+        """
+
+
+    @abc.abstractmethod
+    def queue_key(self, user, offset):
+        """Returns the key of a user's delay_message at offset, or None if there isn't one"""
+
+
+    @abc.abstractmethod
+    def unqueue(self, user, del_ids):
+        """
+        Removes a user's delay_messages with the given ids,
+        or all of them if del_ids is "ALL"
+        Returns the ids that were removed
+        """
+
+
+    @abc.abstractmethod
+    def claim(self, message_ids, worker, now, lease_until):
+        """
+        Leases the due, unclaimed delay_messages with the given ids to a
+        worker until lease_until, so no other worker sends them meanwhile
+        Returns the claimed delay_messages, soonest first
+        """
+
+
+    @abc.abstractmethod
+    def renew(self, message_ids, worker, lease_until):
+        """Extends a worker's lease on delay_messages it is still sending"""
+
+
+    @abc.abstractmethod
+    def defer(self, message_ids, worker, until):
+        """Gives up a worker's claim on delay_messages, letting any worker retry them after until"""
+
+
+    @abc.abstractmethod
+    def finish(self, finished, worker):
+        """
+        Records that a worker sent delay_messages, given as
+        (delay_message, next timestamp or None) pairs
+        Repeating messages are moved to their next timestamp in place,
+        the rest are removed, and ones another worker now holds are left
+        """
+
+
+def is_shared(url):
+    """
+    Checks if separate processes opening a url reach the same messages,
+    which memory:// and in-memory sqlite don't
+    """
+    if not url or url.startswith("memory:"):
+        return False
+    if url.startswith("sqlite:"):
+        path = url[len("sqlite://"):]
+        return path not in ("", "/", "/:memory:")
+    return True
+
+
+def open_storage(url):
+    """
+    Opens the storage a url names
+    memory:// keeps messages in this process only, until it exits
+    sqlite:///path uses a sqlite file, sqlite:// an in-memory one
+    anything else is a SQLAlchemy url, ie postgres://
+    """
+
+    # imported here so small deployments don't need a database driver
+    if url.startswith("memory:"):
+        import memorystorage
+        return memorystorage.MemoryStorage()
+    if url.startswith("sqlite:"):
+        import sqlitestorage
+        path = url[len("sqlite://"):]
+        # sqlite:///relative.db and sqlite:////absolute.db, as SQLAlchemy reads them
+        return sqlitestorage.SqliteStorage(path[1:] if path else ":memory:")
+    import sqlstorage
+    return sqlstorage.SqlStorage(url)
@@ -0,0 +1,126 @@
+#!usr/bin/python
+
+# keeps track of which Zulip streams DelayBot can post delayed messages to
+
+from __future__ import unicode_literals
+
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# how old a cached stream list can be before it is fetched again, in seconds
+CACHE_TTL = int(os.environ.get("DELAYBOT_STREAM_CACHE_TTL", 24 * 60 * 60))
+
+
+class StreamRegistry(object):
+
+    def __init__(self, cache_file=None):
+        """
+        StreamRegistry holds the names of every stream DelayBot is
+        subscribed to, and optionally a file to cache them in
+        so warm starts don't need to fetch them again
+        """
+        self.cache_file = cache_file
+        self.names = set()
+        self.lock = threading.Lock()
+
+
+    def __contains__(self, name):
+        return name in self.names
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def load(self):
+        """
+        Reads the cached stream names, if there is a fresh enough cache
+        Returns whether it did
+        """
+
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return False
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+            if time.time() - cache["saved"] > CACHE_TTL:
+                return False
+            names = cache["names"]
+        except (IOError, ValueError, KeyError):
+            logger.warning("Ignoring unreadable stream cache %s", self.cache_file)
+            return False
+
+        with self.lock:
+            self.names = set(names)
+        logger.info("Loaded %d streams from %s", len(names), self.cache_file)
+        return True
+
+
+    def save(self):
+        """Caches the stream names, replacing the old file in one step"""
+        if not self.cache_file:
+            return
+        with self.lock:
+            cache = {"saved": time.time(), "names": sorted(self.names)}
+        temp_file = self.cache_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(cache, f)
+        os.rename(temp_file, self.cache_file)
+
+
+    def replace(self, names):
+        """Replaces every stream name, ie after a full fetch"""
+        with self.lock:
+            self.names = set(names)
+        self.save()
+
+
+    def add(self, names):
+        """Adds stream names that were subscribed to"""
+        with self.lock:
+            self.names.update(names)
+        self.save()
+
+
+    def remove(self, names):
+        """Removes stream names that were unsubscribed from or deleted"""
+        with self.lock:
+            self.names.difference_update(names)
+        self.save()
+
+
+    def apply_event(self, event):
+        """
+        Updates the registry from a "stream" or "subscription" event
+        Returns the names of any newly created streams
+        """
+
+        op = event.get("op")
+        # peer_add and peer_remove are other users' subscriptions, and
+        # list stream names rather than objects, so op is checked first
+        if event["type"] == "subscription" and op in ("add", "remove"):
+            names = [sub["name"] for sub in event.get("subscriptions", [])]
+            if op == "add":
+                self.add(names)
+            else:
+                self.remove(names)
+
+        elif event["type"] == "stream":
+            names = [stream["name"] for stream in event.get("streams", [])]
+            if op == "create":
+                return names
+            elif op == "delete":
+                self.remove(names)
+            elif op == "update" and event.get("property") == "name":
+                with self.lock:
+                    renamed = event["name"] in self.names
+                if renamed:
+                    self.remove([event["name"]])
+                    self.add([event["value"]])
+
+        return []
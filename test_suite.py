@@ -2,9 +2,39 @@
 
 from __future__ import unicode_literals
 
+import os
+import shutil
+import time
+import tempfile
+import threading
+import multiprocessing
 import unittest
+import warnings
 import timeconversions as TC
 import delaymessage as DM
+import random
+import scheduler
+import timingwheel
+import registration
+import runtime
+import streams
+import recurrence
+import outbox
+import shards
+import storage
+import database
+import schema
+import memorystorage
+import sqlitestorage
+import benchmark
+import bulk
+import metrics
+import urllib2
+import zulip
+import dataset
+import fakezulip
+import loadtest
+import router
 
 class TestGetTimeMethod(unittest.TestCase):
     
@@ -94,6 +124,20 @@ class TestGetTimeMethod(unittest.TestCase):
             self.assertIsNotNone(TC.get_time("12%s" % meridiem))
 
 
+    def testParsedTime(self):
+        parsed = TC.get_time("8:45:59pm")
+        self.assertEqual(parsed, ("clock", 0, 8, 45, 59, "PM"))
+        self.assertEqual(TC.clock_hour(parsed), 20)
+        self.assertEqual(TC.clock_hour(TC.get_time("12a.m.")), 0)
+        self.assertEqual(TC.get_time("1h30m"), ("block", 0, 1, 30, 0, ""))
+        # identical strings share one cached, immutable result
+        self.assertIs(TC.get_time("8:45:59pm"), parsed)
+        with self.assertRaises(AttributeError):
+            parsed.H = 9
+        # a unit given twice is rejected even if the first was 0
+        self.assertRaises(ValueError, TC.get_time, "0m5m")
+
+
     def testBadMeridiems(self):
         for meridiem in self.badMeridiems:
             with self.assertRaises(ValueError):
@@ -102,5 +146,702 @@ class TestGetTimeMethod(unittest.TestCase):
                 TC.get_time("12:00:00%s" % meridiem)
 
 
+class TestGetDeadline(unittest.TestCase):
+
+    def setUp(self):
+        self.timezone = TC.get_timezone("America/New_York")
+
+    def deadline(self, user_time, zulip_time):
+        return TC.get_deadline(TC.get_time(user_time), zulip_time, self.timezone)
+
+    def testClockIsLocal(self):
+        # 2015-06-01 12:00:00 EDT
+        now = 1433174400
+        self.assertEqual(self.deadline("1pm", now), now + TC.HOUR)
+        # already past today, so it is due tomorrow
+        self.assertEqual(self.deadline("11am", now), now + 23 * TC.HOUR)
+
+    def testMonthEnd(self):
+        # 2015-01-31 23:00:00 EST, tomorrow is February 1st
+        now = 1422763200
+        self.assertEqual(self.deadline("9am", now), now + 10 * TC.HOUR)
+        # capped at 23:59:59 the next day
+        self.assertEqual(self.deadline("1d24h", now), now + 25 * TC.HOUR - 1)
+
+    def testDaylightSavings(self):
+        # 2015-03-07 12:00:00 EST, clocks go forward that night
+        now = 1425747600
+        self.assertEqual(self.deadline("9am", now), now + 20 * TC.HOUR)
+        self.assertEqual(self.deadline("1d", now), now + TC.DAY)
+        # 2:30am doesn't exist that night, so it moves forward to 3:30am
+        self.assertEqual(self.deadline("2:30am", now), now + 14 * TC.HOUR + 30 * TC.MINUTE)
+
+
+class TestRecurrence(unittest.TestCase):
+
+    def setUp(self):
+        self.timezone = TC.get_timezone("America/New_York")
+        # 2015-06-05 12:00:00 EDT, a Friday
+        self.now = 1433520000
+
+    def testParseRule(self):
+        rule = recurrence.parse_rule("every", "1h30m")
+        self.assertEqual(rule, ("every", 90 * TC.MINUTE))
+        self.assertEqual(recurrence.load_rule(recurrence.format_rule(rule)), rule)
+        self.assertEqual(recurrence.describe(rule), "every 1h30m")
+        self.assertEqual(recurrence.parse_rule("daily", "9:30pm"), ("daily", 21.5 * TC.HOUR))
+        self.assertRaises(ValueError, recurrence.parse_rule, "every", "9am")
+        self.assertRaises(ValueError, recurrence.parse_rule, "daily", "30m")
+        self.assertRaises(ValueError, recurrence.parse_rule, "every", "30s")
+
+    def testEvery(self):
+        rule = recurrence.parse_rule("every", "2h")
+        first = recurrence.first_fire(rule, self.now, self.timezone)
+        self.assertEqual(first, self.now + 2 * TC.HOUR)
+        self.assertEqual(recurrence.next_fire(rule, first, first, self.timezone),
+                        first + 2 * TC.HOUR)
+        # fires missed while DelayBot was down are skipped
+        late = first + 5 * TC.HOUR
+        self.assertEqual(recurrence.next_fire(rule, first, late, self.timezone),
+                        first + 6 * TC.HOUR)
+
+    def testWeekdays(self):
+        rule = recurrence.parse_rule("weekdays", "9am")
+        first = recurrence.first_fire(rule, self.now, self.timezone)
+        # Monday, since 9am Friday has passed
+        self.assertEqual(first, self.now + 2 * TC.DAY + 21 * TC.HOUR)
+        self.assertEqual(recurrence.next_fire(rule, first, first, self.timezone),
+                        first + TC.DAY)
+        daily = recurrence.parse_rule("daily", "9am")
+        self.assertEqual(recurrence.first_fire(daily, self.now, self.timezone),
+                        self.now + 21 * TC.HOUR)
+
+
+class TestQueueListing(unittest.TestCase):
+
+    def testChunkLines(self):
+        lines = ["a" * 4, "b" * 4, "c" * 4]
+        self.assertEqual(list(DM.chunk_lines(lines, 9)), ["aaaa\nbbbb", "cccc"])
+        self.assertEqual(list(DM.chunk_lines(["x" * 7], 3)), ["xxx", "xxx", "x"])
+        self.assertEqual(list(DM.chunk_lines([])), [])
+
+
+    def testRenderQueue(self):
+        tz = TC.get_timezone("UTC")
+        dm = DM.DelayMessage(0, 60, "Al", "general", "t", "hi", id=1)
+        lines = list(DM.render_queue([dm], tz, True))
+        self.assertEqual(len(lines), 3)
+        self.assertIn("1970-01-01 00:01:00 UTC", lines[1])
+        self.assertIn("queue next", lines[2])
+        self.assertEqual(list(DM.render_queue([], tz, False)),
+                            ["You have no messages queued."])
+
+
+class TestScheduler(unittest.TestCase):
+
+    def make_scheduler(self):
+        return scheduler.Scheduler()
+
+    def setUp(self):
+        self.scheduler = self.make_scheduler()
+        self.scheduler.load([(30, 3), (10, 1), (20, 2)])
+
+    def testPopDue(self):
+        self.assertEqual(self.scheduler.next_deadline(), 10)
+        self.assertEqual(self.scheduler.pop_due(10), [])
+        self.assertEqual(self.scheduler.pop_due(25), [1, 2])
+        self.assertEqual(self.scheduler.next_deadline(), 30)
+        self.assertEqual(len(self.scheduler), 1)
+
+    def testPopDueLimit(self):
+        self.assertEqual(self.scheduler.pop_due(100, 2), [1, 2])
+        self.assertEqual(self.scheduler.pop_due(100, 2), [3])
+
+    def testCancelAndReschedule(self):
+        self.assertTrue(self.scheduler.cancel(1))
+        self.assertFalse(self.scheduler.cancel(1))
+        self.scheduler.push(40, 2)
+        self.assertEqual(self.scheduler.next_deadline(), 30)
+        self.assertEqual(self.scheduler.pop_due(35), [3])
+        self.assertEqual(self.scheduler.pop_due(50), [2])
+        self.assertIsNone(self.scheduler.next_deadline())
+
+    def testSecondsUntilNext(self):
+        self.assertEqual(self.scheduler.seconds_until_next(9.5, 1), 0.5)
+        self.assertEqual(self.scheduler.seconds_until_next(0, 1), 1)
+        self.assertEqual(self.scheduler.seconds_until_next(15, 1), 0)
+
+    def testMergeKeepsLaterTimes(self):
+        self.scheduler.pop_due(15)
+        self.scheduler.merge([(5, 1), (10, 2), (40, 3)])
+        self.assertEqual(self.scheduler.pop_due(100), [1, 2, 3])
+
+    def testMergeReadsOutsideLock(self):
+        free = []
+        def try_lock():
+            if self.scheduler.lock.acquire(False):
+                self.scheduler.lock.release()
+                free.append(True)
+        def pending():
+            for message_id in range(4, 8):
+                # another thread, since the lock is reentrant
+                thread = threading.Thread(target=try_lock)
+                thread.start()
+                thread.join()
+                yield 50, message_id
+        self.scheduler.merge(pending())
+        self.assertEqual(free, [True] * 4)
+        self.assertEqual(len(self.scheduler), 7)
+
+
+class TestTimingWheel(TestScheduler):
+    """Runs the Scheduler tests on small wheels, so they overflow and cascade"""
+
+    def make_scheduler(self):
+        return timingwheel.TimingWheel(tick=1, slots=4, levels=2, start=0)
+
+    def testMatchesHeap(self):
+        rng = random.Random(7)
+        heap = scheduler.Scheduler()
+        wheel = timingwheel.TimingWheel(tick=0.5, slots=4, levels=2, start=0)
+        now = 0
+        for step in range(2000):
+            action = rng.random()
+            message_id = rng.randrange(50)
+            if action < 0.6:
+                timestamp = now + rng.randrange(-2, 40)
+                heap.push(timestamp, message_id)
+                wheel.push(timestamp, message_id)
+            elif action < 0.7:
+                self.assertEqual(heap.cancel(message_id), wheel.cancel(message_id))
+            else:
+                now += rng.random() * 5
+                self.assertEqual(heap.next_deadline(), wheel.next_deadline())
+                self.assertEqual(heap.pop_due(now, 5), wheel.pop_due(now, 5))
+        self.assertEqual(len(heap), len(wheel))
+
+
+class FakeRegisterClient(object):
+
+    def __init__(self, registrations):
+        self.registrations = list(registrations)
+        self.calls = 0
+
+    def register(self, event_types):
+        self.calls += 1
+        return self.registrations.pop(0)
+
+
+class TestRegistration(unittest.TestCase):
+
+    def setUp(self):
+        self.backoff_base = registration.BACKOFF_BASE
+        registration.BACKOFF_BASE = 0
+        self.directory = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.directory, "queue.json")
+
+    def tearDown(self):
+        registration.BACKOFF_BASE = self.backoff_base
+        shutil.rmtree(self.directory)
+
+    def testRetriesUntilRegistered(self):
+        client = FakeRegisterClient([
+            {"result": "connection-error", "msg": ""},
+            {"result": "success", "queue_id": "a", "last_event_id": -1}])
+        r = registration.Registration(client, ["message"], self.state_file)
+        self.assertEqual(r.queue(), ("a", -1))
+        self.assertEqual(client.calls, 2)
+
+    def testResumesAfterRestart(self):
+        client = FakeRegisterClient([
+            {"result": "success", "queue_id": "a", "last_event_id": -1}])
+        r = registration.Registration(client, ["message"], self.state_file)
+        r.queue()
+        r.take(9)
+        r.ack(5)
+        r.save()
+        resumed = registration.Registration(client, ["message"], self.state_file)
+        self.assertEqual(resumed.queue(), ("a", 5))
+        self.assertEqual(client.calls, 1)
+
+    def testAcknowledgesOnlyHandledEvents(self):
+        client = FakeRegisterClient([
+            {"result": "success", "queue_id": "a", "last_event_id": -1}])
+        bot = type(str("Bot"), (object,), {"client": client, "event_types": ["message"],
+                    "state_file": self.state_file, "scheduler": scheduler.Scheduler(),
+                    "handle_event": None})()
+        r = runtime.Runtime(bot)
+        r.registration.queue()
+        r.unhandled.update([0, 1, 2])
+        r.registration.take(2)
+        r.acknowledge("a", 1)
+        self.assertEqual(r.registration.acked, -1)
+        r.acknowledge("a", 0)
+        self.assertEqual(r.registration.acked, 1)
+        r.acknowledge("a", 2)
+        self.assertEqual(r.registration.acked, 2)
+
+    def testOnlyExpiredQueuesAreDropped(self):
+        client = FakeRegisterClient([
+            {"result": "success", "queue_id": "a", "last_event_id": -1},
+            {"result": "success", "queue_id": "b", "last_event_id": 10}])
+        r = registration.Registration(client, ["message"])
+        r.queue()
+        r.fail({"result": "http-error", "msg": "Unexpected error from the server"})
+        self.assertEqual(r.queue(), ("a", -1))
+        r.fail({"result": "error", "msg": "Bad event queue id: a"})
+        self.assertEqual(r.queue(), ("b", 10))
+
+
+class FakeSendClient(object):
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.sent = []
+
+    def send_message(self, message):
+        self.sent.append(message)
+        return self.results.pop(0)
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.retry_base = outbox.RETRY_BASE
+        outbox.RETRY_BASE = 0
+
+    def tearDown(self):
+        outbox.RETRY_BASE = self.retry_base
+
+    def testTokenBucket(self):
+        now = [0]
+        bucket = outbox.TokenBucket(2, 2, lambda: now[0])
+        self.assertEqual([bucket.take(), bucket.take()], [0, 0])
+        self.assertEqual(bucket.take(), 0.5)
+        now[0] = 0.5
+        self.assertEqual(bucket.take(), 0)
+        bucket.hold(3)
+        self.assertEqual(bucket.take(), 3.5)
+
+    def testRetriesUntilSent(self):
+        client = FakeSendClient([
+            {"result": "connection-error", "msg": ""},
+            {"result": "error", "msg": "API usage exceeded rate limit",
+                "retry-after": 0},
+            {"result": "success"}])
+        box = outbox.Outbox(client, rate=1000, burst=10)
+        self.assertEqual(box.send({"to": "a"}), outbox.SENT)
+        self.assertEqual(len(client.sent), 3)
+
+    def testRejectedIsNotRetried(self):
+        client = FakeSendClient([{"result": "error", "msg": "Stream does not exist"}])
+        box = outbox.Outbox(client)
+        self.assertEqual(box.send({"to": "a"}), outbox.REJECTED)
+        box.close()
+        self.assertEqual(box.send({"to": "a"}), outbox.DEFERRED)
+
+    def testCoalescesReplies(self):
+        client = FakeSendClient([{"result": "success"}])
+        box = outbox.Outbox(client, coalesce=60)
+        box.reply("a", "one")
+        box.reply("a", "two")
+        box.close()
+        self.assertEqual([m["content"] for m in client.sent], ["one\n\ntwo"])
+
+
+class TestShards(unittest.TestCase):
+
+    def testShardForIsStable(self):
+        self.assertEqual(shards.shard_for("a@x", 3), 1)
+        self.assertEqual(shards.shard_for("d@x", 3), 0)
+        for count in range(1, 10):
+            self.assertIn(shards.shard_for("someone@example.com", count), range(count))
+
+    def testDeadShardStopsRouting(self):
+        pool = shards.ShardPool(None, 1, backlog=1)
+        stopped = []
+        pool.on_failure = lambda: stopped.append(True)
+        process = multiprocessing.Process(target=int, name="shard-0")
+        process.start()
+        process.join()
+        pool.processes.append(process)
+        event = {"type": "message", "message": {"sender_email": "al@x"}}
+        self.assertRaises(RuntimeError, pool.handle_event, event)
+        self.assertRaises(RuntimeError, pool.handle_event, event)
+        self.assertEqual((stopped, pool.failed), ([True], "shard-0"))
+        pool.close()
+
+    def testNeedsSharedStorage(self):
+        for url in ["memory://", "sqlite://", "sqlite:///:memory:"]:
+            self.assertFalse(storage.is_shared(url))
+        for url in ["sqlite:///delaybot.db", "sqlite:////tmp/delaybot.db", "postgres://db/bot"]:
+            self.assertTrue(storage.is_shared(url))
+        bot = benchmark.make_bot()
+        database.connect("memory://")
+        self.assertRaises(RuntimeError, bot.main, processes=2)
+
+
+class StorageContract(object):
+    """Tests every storage backend must pass, mixed into a TestCase per backend"""
+
+    def setUp(self):
+        self.storage = self.make_storage()
+        database.set_storage(self.storage)
+        self.storage.boot()
+        self.ids = [self.storage.add(DM.DelayMessage(0, 10 + i % 2, user, "g", "t", "m"))
+                    for i, user in enumerate(["Al", "Al", "Al", "Bo"])]
+
+    def tearDown(self):
+        database.set_storage(None)
+
+    def testQueuePages(self):
+        self.assertEqual([dm.id for dm in self.storage.queue_page("Al", None, 2)], [1, 3])
+        after = self.storage.queue_key("Al", 1)
+        self.assertEqual(after, (10, 3))
+        self.assertEqual([dm.id for dm in self.storage.queue_page("Al", after, 2)], [2])
+        self.assertIsNone(self.storage.queue_key("Al", 3))
+
+    def testClaimsAreExclusive(self):
+        claimed = self.storage.claim(self.ids, "A", 10, 100)
+        self.assertEqual([dm.id for dm in claimed], [1, 3])
+        self.assertEqual(self.storage.claim(self.ids, "B", 10, 100), [])
+        self.storage.defer([1], "A", 50)
+        self.storage.finish([(claimed[1], None)], "A")
+        self.assertEqual(sorted(self.storage.pending()), [(11, 2), (11, 4), (50, 1)])
+        self.assertEqual(self.storage.due(11), [(11, 2), (11, 4)])
+
+    def testDueSkipsHeldMessages(self):
+        self.storage.claim([1], "A", 10, 20)
+        self.assertEqual(database.get_due(15, 2), [(10, 3), (11, 2)])
+        self.assertEqual(database.get_due(20), [(10, 1), (10, 3), (11, 2), (11, 4)])
+
+    def testUnqueue(self):
+        self.assertEqual(self.storage.unqueue("Al", [1, 4]), [1])
+        self.assertEqual(self.storage.unqueue("Al", [2, 2]), [2])
+        self.assertEqual(sorted(self.storage.unqueue("Al", "ALL")), [3])
+        self.assertEqual(list(self.storage.pending()), [(11, 4)])
+
+    def testPendingStreamsInBatches(self):
+        batch = storage.PENDING_BATCH
+        storage.PENDING_BATCH = 3
+        try:
+            pending = self.storage.pending()
+            self.assertEqual(next(pending), (10, 1))
+            self.assertEqual(sorted(pending), [(10, 3), (11, 2), (11, 4)])
+        finally:
+            storage.PENDING_BATCH = batch
+
+    def testAddMany(self):
+        dms = [DM.DelayMessage(0, 5 - i, "Cy", "g", "t", "m") for i in range(3)]
+        self.storage.add_many(dms)
+        self.assertEqual([dm.id for dm in dms], [5, 6, 7])
+        self.assertEqual(self.storage.queue_key("Cy", 0), (3, 7))
+
+
+class TestMemoryStorage(StorageContract, unittest.TestCase):
+
+    def make_storage(self):
+        return memorystorage.MemoryStorage()
+
+    def testIncompleteBackendCantBeCreated(self):
+        partial = type(str("Partial"), (storage.Storage,), {"boot": lambda self: 1})
+        self.assertRaises(TypeError, partial)
+
+
+class TestSqliteStorage(StorageContract, unittest.TestCase):
+
+    def make_storage(self):
+        return sqlitestorage.SqliteStorage(":memory:")
+
+
+class TestUnqueue(unittest.TestCase):
+
+    def setUp(self):
+        database.set_storage(memorystorage.MemoryStorage())
+        self.bot = benchmark.make_bot()
+        self.replies = []
+        self.bot.send_private_message = lambda to, content: self.replies.append(content)
+        for i in range(12):
+            self.command("DelayBot %dh %s t m%d" % (i + 1, benchmark.STREAM, i))
+
+    def tearDown(self):
+        database.set_storage(None)
+
+    def command(self, content):
+        self.bot.respond(benchmark.make_command(content))
+        return self.replies[-1]
+
+    def testSomeMissing(self):
+        self.assertEqual(self.command("DelayBot unqueue 3 7 13"),
+                "Successfully unqueued your messages! You have nothing queued with the ID 13.")
+        self.assertEqual(self.command("DelayBot unqueue 3 13 14"),
+                "You have nothing queued with that ID.")
+        self.assertEqual(self.command("DelayBot unqueue 12 14 15"),
+                "Successfully unqueued your message! You have nothing queued with the IDs 14, 15.")
+        self.assertEqual(len(self.bot.scheduler), 9)
+
+    def testAll(self):
+        self.assertEqual(self.command("DelayBot unqueue ALL"), "Successfully unqueued your messages!")
+        self.assertEqual(len(self.bot.scheduler), 0)
+        self.assertEqual(self.command("DelayBot unqueue ALL"), "You have nothing queued with that ID.")
+
+
+class TestSync(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = memorystorage.MemoryStorage()
+        database.set_storage(self.storage)
+        self.bot = benchmark.make_bot()
+        self.now = int(time.time())
+
+    def tearDown(self):
+        database.set_storage(None)
+
+    def add(self, timestamp):
+        return self.storage.add(DM.DelayMessage(0, timestamp, "Al", "g", "t", "m"))
+
+    def testReadsNewAndUnheldMessages(self):
+        stalled = self.add(self.now - 10)
+        known = self.add(self.now + 100)
+        self.bot.scheduler.load(self.bot.read_pending())
+        # another worker claimed one and stopped, and the other was sent
+        self.assertEqual(self.bot.scheduler.pop_due(self.now), [stalled])
+        self.storage.claim([stalled], "other", self.now, self.now - 1)
+        self.bot.scheduler.cancel(known)
+        queued = self.add(self.now + 200)
+
+        self.bot.sync_schedule()
+        # only ids above the last read are read again
+        self.assertEqual(self.bot.synced_id, queued)
+        self.assertEqual(self.bot.scheduler.pop_due(self.now + 1000), [stalled, queued])
+
+
+class TestSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "legacy.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testUpgradesLegacyTable(self):
+        # a row as DelayBot stored them before the schema was explicit,
+        # dataset warns about its own use of alembic
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            with dataset.connect("sqlite:///" + self.path) as db:
+                db["messages"].insert({"dateStored": "01/02/17 09:00",
+                        "timestamp": 1483400000.0, "date": "01/03/17 09:00",
+                        "user": "Al", "stream": "g", "topic": "t", "message": "m"})
+
+        for boot in range(2):
+            backend = sqlitestorage.SqliteStorage(self.path)
+            self.assertEqual(backend.boot(), len(schema.MIGRATIONS))
+        columns = [row["name"] for row in backend.read("PRAGMA table_info(messages)")]
+        for column in ["stored", "rule", "claimed_by", "lease_until", "dateStored"]:
+            self.assertIn(column, columns)
+        indexes = [row["name"] for row in backend.read("PRAGMA index_list(messages)")]
+        self.assertIn("ix_messages_timestamp", indexes)
+        self.assertIn("ix_messages_user_timestamp", indexes)
+        self.assertNotIn("ix_messages_user_date", indexes)
+        self.assertEqual(list(backend.pending()), [(1483400000, 1)])
+        self.assertEqual([dm.message for dm in backend.queue_page("Al")], ["m"])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def testRegressionDirection(self):
+        self.assertTrue(benchmark.is_regression("dispatch.1000.batch_ms", 13, 10))
+        self.assertFalse(benchmark.is_regression("dispatch.1000.batch_ms", 5, 10))
+        self.assertTrue(benchmark.is_regression("parse_time.cold.ops_per_sec", 70, 100))
+        self.assertFalse(benchmark.is_regression("parse_time.cold.ops_per_sec", 200, 100))
+
+    def testSmallRun(self):
+        results = benchmark.bench_size(100, "memory://", batches=2)
+        self.assertEqual(sorted(results), ["boot.100_ms", "dispatch.100.batch_ms",
+                "queue.100.first_page_ms", "queue.100.last_page_ms",
+                "store.100.inserts_per_sec"])
+
+
+class TestBulk(unittest.TestCase):
+
+    def testLines(self):
+        uploads = {"/user_uploads/1/a/b.csv": b"time,stream,topic,message\n1h,455 Broadway,hi,hey there\n"}
+        commands = bulk.read_lines(["1h g t hello", "", "[b.csv](/user_uploads/1/a/b.csv)"],
+                                    uploads.get)
+        self.assertEqual(commands, ["1h g t hello", "1h 455_Broadway hi hey there"])
+
+    def testJson(self):
+        data = b'[{"time": "daily 9am", "stream": "g", "topic": "t", "message": "m"}]'
+        self.assertEqual(bulk.read_upload(data, "json"), ["daily 9am g t m"])
+        self.assertRaises(ValueError, bulk.read_upload, b'{"time": "1h"}', "json")
+        self.assertRaises(ValueError, bulk.read_upload, b"1h,g,t", "csv")
+
+    def testDownloadStopsAtLimit(self):
+        def chunks():
+            yield b"x" * bulk.MAX_UPLOAD
+            yield b"x"
+            self.fail("read past the limit")
+        self.assertEqual(bulk.read_download([b"a", b"b"], float("inf")), b"ab")
+        self.assertRaises(ValueError, bulk.read_download, chunks(), float("inf"))
+        self.assertRaises(ValueError, bulk.read_download, [b"a"], 0)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def tearDown(self):
+        metrics.enable(False)
+
+    def testDisabledRecordsNothing(self):
+        histogram = metrics.Histogram("test_disabled_seconds", "Test.")
+        histogram.observe(1)
+        with histogram.time():
+            pass
+        self.assertEqual(histogram.values, {})
+
+    def testServe(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", (1, 5), label="call")
+        counter = metrics.Counter("test_total", "Test.")
+        server = metrics.serve(0)
+        histogram.observe(0.5, "a")
+        histogram.observe(3, "a")
+        counter.inc()
+        try:
+            text = urllib2.urlopen("http://127.0.0.1:%d/metrics" % server.server_port).read()
+        finally:
+            server.shutdown()
+        self.assertIn('test_seconds_bucket{call="a",le="1"} 1\n', text)
+        self.assertIn('test_seconds_bucket{call="a",le="+Inf"} 2\n', text)
+        self.assertIn('test_seconds_sum{call="a"} 3.5\n', text)
+        self.assertIn("test_total 1\n", text)
+
+
+class TestFakeZulip(unittest.TestCase):
+
+    def setUp(self):
+        self.zulip = fakezulip.FakeZulip(["general"], heartbeat=0.1)
+        self.client = zulip.Client("bot@example.com", "key", site=self.zulip.start())
+
+    def tearDown(self):
+        self.zulip.stop()
+
+    def testEvents(self):
+        queue = self.client.register("[\"message\"]")
+        self.zulip.add_message("ping", "al@example.com")
+        events = self.client.get_events(queue_id=queue["queue_id"],
+                                        last_event_id=queue["last_event_id"])["events"]
+        self.assertEqual([event["message"]["content"] for event in events], ["ping"])
+        heartbeat = self.client.get_events(queue_id=queue["queue_id"],
+                                            last_event_id=events[-1]["id"])["events"]
+        self.assertEqual(heartbeat[0]["type"], "heartbeat")
+        # like Zulip, events polled after are dropped
+        dropped = self.client.get_events(queue_id=queue["queue_id"],
+                                        last_event_id=queue["last_event_id"])["events"]
+        self.assertEqual([event["type"] for event in dropped], ["heartbeat"])
+        expired = self.client.get_events(queue_id="gone", last_event_id=-1)
+        self.assertEqual(expired["code"], "BAD_EVENT_QUEUE_ID")
+
+    def testUnhandledEventsArePolledAgain(self):
+        bot = type(str("Bot"), (object,), {"client": self.client, "event_types": ["message"],
+                    "state_file": None, "scheduler": scheduler.Scheduler(),
+                    "handle_event": None})()
+        r = runtime.Runtime(bot)
+        queue_id, acked = r.registration.queue()
+        self.zulip.add_message("one", "al@example.com")
+        self.zulip.add_message("two", "al@example.com")
+        polled = []
+        get_events = self.client.get_events
+        def poll(**kwargs):
+            polled.append(kwargs["last_event_id"])
+            if len(polled) == 2:
+                r.stop()
+            return get_events(**kwargs)
+        self.client.get_events = poll
+        r.poll_events()
+        # the second poll is after the last handled event, and its events aren't taken twice
+        self.assertEqual(polled, [acked, acked])
+        items = [r.events.get_nowait() for i in range(r.events.qsize())]
+        self.assertEqual([event["message"]["content"] for q, event in items], ["one", "two"])
+        for q, event in items:
+            r.acknowledge(queue_id, event["id"])
+        self.assertEqual(r.registration.acked, items[-1][1]["id"])
+
+    def testSends(self):
+        message = {"type": "stream", "to": "general", "subject": "t", "content": "lt-1 hi"}
+        self.assertEqual(self.client.send_message(message)["result"], "success")
+        self.assertEqual(loadtest.deliveries(self.zulip).keys(), [1])
+
+    def testFormatDelay(self):
+        self.assertEqual(loadtest.format_delay(5), "5s")
+        self.assertEqual(loadtest.format_delay(3665), "1h1m5s")
+
+
+class TestRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.router = router.Router("delaybot")
+        self.router.add("queue", "queue", [router.Arg("page", optional=True)])
+        self.router.add(None, "delay", [router.Arg("time"), router.Body("message")],
+                        [router.Arg("time"), router.Arg("stream"), router.Body("message")],
+                        missing="public", private_missing="private")
+
+    def route(self, content, private=False):
+        command, args = self.router.route(content, private)
+        return command.handler, args
+
+    def testChatterIsIgnored(self):
+        self.assertIsNone(self.router.route("lunch at delaybot's?", False))
+        self.assertRaises(ValueError, self.router.route, "  @**DelayBot**  ", False)
+
+    def testBodyKeepsFormatting(self):
+        body = "two  spaces\n```\ncode\n```"
+        self.assertEqual(self.route("@**DelayBot**  1h\n" + body),
+                        ("delay", {"time": "1h", "message": body}))
+        self.assertEqual(self.route("1h  general " + body, True),
+                        ("delay", {"time": "1h", "stream": "general", "message": body}))
+
+    def testCommands(self):
+        self.assertEqual(self.route("DelayBot QUEUE"), ("queue", {}))
+        self.assertEqual(self.route("queue next", True), ("queue", {"page": "next"}))
+        self.assertRaises(ValueError, self.router.route, "DelayBot 1h", False)
+        with self.assertRaises(ValueError) as raised:
+            self.router.route("1h general", True)
+        self.assertEqual(raised.exception.message, "private")
+
+
+class TestStreamRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.directory, "streams.json")
+        self.registry = streams.StreamRegistry(self.cache_file)
+        self.registry.replace(["general", "social"])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testEvents(self):
+        created = self.registry.apply_event({"type": "stream", "op": "create",
+                                            "streams": [{"name": "new"}]})
+        self.assertEqual(created, ["new"])
+        self.assertNotIn("new", self.registry)
+        self.registry.apply_event({"type": "subscription", "op": "add",
+                                    "subscriptions": [{"name": "new"}]})
+        self.registry.apply_event({"type": "subscription", "op": "remove",
+                                    "subscriptions": [{"name": "general"}]})
+        self.registry.apply_event({"type": "stream", "op": "update",
+                                    "property": "name", "name": "social", "value": "fun"})
+        self.assertEqual(self.registry.apply_event({"type": "subscription", "op": "peer_add",
+                                    "subscriptions": ["fun"], "user_email": "al@x"}), [])
+        self.assertEqual(self.registry.names, set(["new", "fun"]))
+
+    def testWarmStart(self):
+        cached = streams.StreamRegistry(self.cache_file)
+        self.assertTrue(cached.load())
+        self.assertIn("social", cached)
+        self.assertFalse(streams.StreamRegistry().load())
+
+
 if __name__ == "__main__":
     unittest.main()
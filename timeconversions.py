@@ -4,171 +4,269 @@
 
 from __future__ import unicode_literals
 
+import os
 import re
-import time
+import logging
+import calendar
 import datetime
+import threading
+import collections
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+# clock times are read in this timezone unless another is given
+DEFAULT_TIMEZONE = os.environ.get("DELAYBOT_TIMEZONE", "America/New_York")
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
 
 # hardcoded data information for verifying input
 
 # time limits for block format: days, hours, minutes, seconds
 block_limits = {'D': 1, 'H': 24, 'M': 60, 'S': 60}
-regexp = "[0-9]{1,2}[HMDS]{1}"
-# verifies block format
-block_regexp_match = re.compile("^(%s){1,4}$" % regexp)
-# filters parts out of block format
-block_regexp_find = re.compile(regexp)
 
 # valid meridiems (including none given)
 meridiems = set(["AM", 'PM', "A.M.", "P.M.", ""])
-# time limits for clock format: hours, minutes, seconds
+# names of clock format parts: hours, minutes, seconds
 clock_format = ["H", "M", "S"]
-clock_limits = [23, 59, 59]
 
+# splits a time into numbers, colons and words in a single pass,
+# every character falls into exactly one of these
+NUMBER, COLON, WORD = 1, 2, 3
+token_regexp = re.compile("([0-9]+)|(:)|([^0-9:]+)")
+# the shape of a time is a character per token, ie "1d30m" is "nwnw"
+shape_chars = {NUMBER: "n", COLON: ":", WORD: "w"}
+block_shape = re.compile("^(nw){1,4}$")
+
+# how many distinct time strings have their parsed result remembered
+CACHE_SIZE = 1024
+
+# an immutable parsed time, clock and single times keep their meridiem
+# and 12hr hour, block times have no meridiem
+ParsedTime = collections.namedtuple("ParsedTime", "format D H M S meridiem")
+
+
+class LRUCache(object):
+
+    def __init__(self, size):
+        """A thread safe mapping that forgets its least recently used keys"""
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        """Returns the value for a key, or None if it isn't cached"""
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return None
+            self.items[key] = value
+            return value
+
+
+    def put(self, key, value):
+        """Caches a value, forgetting the oldest one if over size"""
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+parsed_times = LRUCache(CACHE_SIZE)
+
+
+def get_timezone(name=None):
+    """Returns a timezone by its tz database name, ie America/New_York"""
+    return pytz.timezone(name or DEFAULT_TIMEZONE)
 
-def parse_time(user_time, zulip_time):
+
+def parse_time(user_time, zulip_time, timezone):
     """
-    Handles parsing a given time message
-    Returns a unix time, the date/time it represents,
-    and the date/time of when the zulip message was sent
+    Handles parsing a given time message, with clock times read in timezone
+    Returns the unix time it represents
     """
 
-    zulip_datetime = datetime.datetime.fromtimestamp(zulip_time)
-    time_dict = get_time(user_time)
-    time_delay = get_time_delay(time_dict, zulip_datetime)
-    unix = time.mktime(time_delay.timetuple())
+    parsed = get_time(user_time)
+    return get_deadline(parsed, int(zulip_time), timezone)
+
+
+def format_time(unix, timezone):
+    """Renders a unix time as a readable date/time in timezone"""
+    local = datetime.datetime.fromtimestamp(unix, timezone)
+    return local.strftime("%Y-%m-%d %H:%M:%S %Z")
+
+
+def tokenize(user_time):
+    """Splits a time into (kind, text) tokens, with the text in upper case"""
+    return [(match.lastindex, match.group())
+            for match in token_regexp.finditer(user_time.upper())]
 
-    return unix, str(time_delay), str(zulip_datetime)
 
-def check_block_time(user_time, time_dict):
+def check_block_time(tokens):
     """Filters time for variable length block format"""
 
-    user_time = block_regexp_find.findall(user_time)
-    # used to check if all values are 0
-    total = 0
+    values = {'D': 0, 'H': 0, 'M': 0, 'S': 0}
+    # used to check if a value was given twice
+    seen = set()
 
-    for value in user_time:
+    for i in range(0, len(tokens), 2):
 
-        char = value[-1]
-        if time_dict[char] != 0:
+        value = int(tokens[i][1])
+        char = tokens[i + 1][1]
+        if char in seen:
             raise ValueError("You defined the time for %s twice. Define it only once." % char)
+        seen.add(char)
 
-        time_dict[char] = int(value[:-1])
-        total += time_dict[char]
-        if time_dict[char] > block_limits[char]:
-            raise ValueError("%s is too high for the %s in block format." % (time_dict[char], char))
+        if value > block_limits[char]:
+            raise ValueError("%s is too high for the %s in block format." % (value, char))
+        values[char] = value
 
-    if total == 0:
+    if not any(values.values()):
         raise ValueError("You must specify at least one non-zero value.")
 
-    return time_dict
+    return ParsedTime("block", values['D'], values['H'], values['M'], values['S'], "")
 
 
-def check_clock_time(user_time, time_dict):
+def check_clock_time(tokens, time_format):
     """Filters time for 24hr, 12hr clocks, and single hours"""
 
-    if time_dict["format"] == "clock":
-        # clock times are in the format Hh:Mm(:Ss)[meridiem]
-        # so the meridiem will always start at the 3rd character
-        meridiem_point = 2
-        user_time = user_time.split(":")
-    elif time_dict["format"] == "single":
-        # if the length is odd, that means that the hour is a single digit
-        # and meridiem_point needs to account for that. ie 1am vs 12am
-        meridiem_point = 2 - len(user_time) % 2
-        # rest of function expects a list
-        user_time = [user_time]
-
-    if len(user_time) > 3:
+    meridiem = ""
+    if tokens[-1][0] == WORD:
+        meridiem = tokens[-1][1]
+        tokens = tokens[:-1]
+    if meridiem not in meridiems:
+        raise ValueError("\"%s\" is not a meridiem." % meridiem)
+
+    # clock times are in the format Hh:Mm(:Ss)[meridiem]
+    parts = [""]
+    for kind, text in tokens:
+        if kind == COLON:
+            parts.append("")
+        elif kind == NUMBER:
+            parts[-1] = text
+        else:
+            raise ValueError("You must give only numbers for time, not \"%s\"." % text)
+
+    if len(parts) > 3:
         raise ValueError("Specific must be Hh[meridiem], Hh:Mm, or Hh:Mm:Ss.")
 
-    time_dict["meridiem"] = user_time[-1][meridiem_point:]
-    user_time[-1] = user_time[-1][:meridiem_point]
-    if time_dict["meridiem"] not in meridiems:
-        raise ValueError("\"%s\" is not a meridiem." % time_dict["meridiem"])
     # the hour limit must account for 12hr clock vs 23hr clock
-    global clock_limits
-    clock_limits[0] = 12 if time_dict["meridiem"] else 23
-
-    for i, value in enumerate(user_time):
-        if not value.isdigit():
-            if value:
-                raise ValueError("You must give only numbers for time, not \"%s\"." % value)
-            else:
-                raise ValueError("You didn't specify any time for the %s." % clock_format[i])
+    limits = [12 if meridiem else 23, 59, 59]
+    values = [0, 0, 0]
+    for i, value in enumerate(parts):
+        if not value:
+            raise ValueError("You didn't specify any time for the %s." % clock_format[i])
+        if len(value) > 2:
+            raise ValueError("You can only give two digits for the %s, not \"%s\"." % (
+                                clock_format[i], value))
 
         value = int(value)
-        if value > clock_limits[i]:
+        if value > limits[i]:
             raise ValueError("%s is too high for the %s." % (value, clock_format[i]))
-        time_dict[clock_format[i]] = value
+        values[i] = value
 
-    if time_dict["meridiem"] and time_dict["H"] == 0:
+    if meridiem and values[0] == 0:
         raise ValueError("You cannot give 0 for the H in 12hr or single format.")
 
-    return time_dict
+    return ParsedTime(time_format, 0, values[0], values[1], values[2], meridiem)
 
 
 def get_time(user_time):
     """
-    Returns a dict of time formatted from user_time, or None on invalid input
+    Returns a ParsedTime from user_time, raising a ValueError on invalid input
     Proper time formats and their limits:
         block: 1D24H60M60S
         clock (24hr): 23:59, 23:59:59
         clock (12hr): 12:59AM, 12:59:59P.M.
         single: 12AM, 12P.M.
+    Results are cached, and safe to share since they can't be changed
     """
 
-    time_dict = {"D": 0, "H": 0, "M": 0, "S": 0, "meridiem": "", "format": ""}
-
-    user_time_caps = user_time.upper()
-    print user_time
-
-    if block_regexp_match.match(user_time_caps):
-        time_dict["format"] = "block"
-    elif ":" in user_time:
-        time_dict["format"] = "clock"
-    elif (user_time_caps[-2:] in meridiems or
-            user_time_caps[-4:] in meridiems):
-        time_dict["format"] = "single"
+    parsed = parsed_times.get(user_time)
+    if parsed is not None:
+        return parsed
+
+    logger.debug("Parsing time %s", user_time)
+    tokens = tokenize(user_time)
+    shape = "".join(shape_chars[kind] for kind, text in tokens)
+
+    if (block_shape.match(shape) and
+            all(len(text) <= 2 for kind, text in tokens[::2]) and
+            all(text in block_limits for kind, text in tokens[1::2])):
+        parsed = check_block_time(tokens)
+    elif ":" in shape:
+        parsed = check_clock_time(tokens, "clock")
+    elif shape == "nw" and tokens[1][1] in meridiems:
+        parsed = check_clock_time(tokens, "single")
     else:
         raise ValueError("\"%s\" is not a valid time format. You might "
                         "have misentered a different command." % user_time)
 
-    if time_dict["format"] == "block":
-        time_dict = check_block_time(user_time_caps, time_dict)
-    elif time_dict["format"] in ("clock", "single"):
-        time_dict = check_clock_time(user_time_caps, time_dict)
+    parsed_times.put(user_time, parsed)
+    return parsed
+
 
-    return time_dict
+def clock_hour(parsed):
+    """Returns the 24hr hour of a clock or single ParsedTime"""
+    hour = parsed.H
+    if parsed.meridiem:
+        hour %= 12
+        if "P" in parsed.meridiem:
+            hour += 12
+    return hour
 
 
-def get_time_delay(time_dict, zulip_datetime):
+def to_unix(local):
+    """Converts a timezone aware datetime to unix time"""
+    return calendar.timegm(local.utctimetuple())
+
+
+def localize(timezone, date, hour, minute, second):
     """
-    Converts a given time to a datetime object at a later date
-    uses the original zulip message timestamp for some calculations
-    time_delay will be truncated to 11:59PM the next day if it goes over
+    Returns the unix time of a wall clock time on a date in timezone
+    Times skipped by a DST change move forward past it,
+    and times repeated by one use their first occurrence
     """
+    naive = datetime.datetime.combine(date, datetime.time(hour, minute, second))
+    try:
+        local = timezone.localize(naive, is_dst=None)
+    except pytz.AmbiguousTimeError:
+        local = timezone.localize(naive, is_dst=True)
+    except pytz.NonExistentTimeError:
+        # read with the offset from before the change, then normalized
+        local = timezone.normalize(timezone.localize(naive, is_dst=False))
+    return to_unix(local)
+
+
+def block_seconds(parsed):
+    """Returns the length of a block ParsedTime in seconds"""
+    return parsed.D * DAY + parsed.H * HOUR + parsed.M * MINUTE + parsed.S
 
-    time_delay = None
 
-    if time_dict["format"] == "block":
-        delta = datetime.timedelta(days=time_dict["D"], hours=time_dict["H"],
-                        minutes=time_dict["M"], seconds=time_dict["S"])
-        time_delay = zulip_datetime + delta
+def get_deadline(parsed, zulip_time, timezone):
+    """
+    Converts a ParsedTime to the unix time it is due at, measured from
+    the unix time the zulip message was sent, with clock times read in
+    timezone
+    The deadline will be truncated to 11:59:59PM the next day if it goes over
+    """
 
-    elif time_dict["format"] in ("clock", "single"):
-        if time_dict["H"] == 12:
-            time_dict["H"] = 0
-        if "P" in time_dict["meridiem"]:
-            time_dict["H"] += 12
+    today = datetime.datetime.fromtimestamp(zulip_time, timezone).date()
+    tomorrow = today + datetime.timedelta(days=1)
 
-        time_delay = datetime.datetime(zulip_datetime.year, zulip_datetime.month,
-                            zulip_datetime.day, time_dict["H"], time_dict["M"], time_dict["S"])
-        if time_delay < zulip_datetime:
-            time_delay += datetime.timedelta(days=1)
+    if parsed.format == "block":
+        deadline = zulip_time + block_seconds(parsed)
+    else:
+        hour = clock_hour(parsed)
+        deadline = localize(timezone, today, hour, parsed.M, parsed.S)
+        if deadline < zulip_time:
+            deadline = localize(timezone, tomorrow, hour, parsed.M, parsed.S)
 
     # gives a hard limit to how long it can delay until
-    if time_delay.day > (zulip_datetime.day + 1):
-        time_delay = datetime(zulip_datetime.year, zulip_datetime.month,
-                            zulip_datetime.day + 1, 23, 59, 59)
-
-    return time_delay
+    return min(deadline, localize(timezone, tomorrow, 23, 59, 59))
@@ -0,0 +1,215 @@
+#!usr/bin/python
+
+# a hierarchical timing wheel schedule, for instances holding millions of
+# pending delay messages, where even a heap's log n per change adds up
+
+from __future__ import unicode_literals
+
+import time
+import heapq
+
+import scheduler
+
+# seconds per tick of the finest wheel, messages due in the same tick
+# leave the wheel together and are ordered exactly after that
+TICK = 0.1
+# slots per wheel, and wheels, so 256 ** 4 ticks (13 years) are covered
+SLOTS = 256
+LEVELS = 4
+
+
+class TimingWheel(scheduler.Scheduler):
+
+    def __init__(self, tick=TICK, slots=SLOTS, levels=LEVELS, start=None):
+        """
+        TimingWheel is a Scheduler that keeps messages in wheels of slots,
+        where a slot of each wheel spans a whole turn of the one below it
+        Pushing and cancelling are O(1) dict operations, and messages move
+        down a wheel only when its turn reaches their slot
+        Messages due by the current tick sit in the Scheduler's heap, so
+        they still come out soonest first, to the second or better
+        start is the time the wheels start turning from, defaulting to now
+        """
+        scheduler.Scheduler.__init__(self)
+        self.tick = float(tick)
+        self.slots = slots
+        self.levels = levels
+        # ticks per slot of each wheel
+        self.spans = [slots ** level for level in range(levels)]
+        self.start = start
+        self.reset()
+
+
+    def reset(self):
+        """Empties every wheel, and sets them to the current tick"""
+        self.current = int((time.time() if self.start is None else self.start) // self.tick)
+        # level -> slot -> {id: timestamp}
+        self.wheels = [[{} for slot in range(self.slots)] for level in range(self.levels)]
+        # messages in each wheel, so empty ones can be skipped
+        self.counts = [0] * self.levels
+        # id -> (level, slot) of every message in a wheel
+        self.places = {}
+        # id -> timestamp of messages beyond the last wheel
+        self.overflow = {}
+        self.heap = []
+        self.entries = {}
+        # the deadline wait() last slept towards, sooner pushes wake it
+        self.deadline = None
+
+
+    def place(self, timestamp, message_id):
+        """Puts a message in the heap, a wheel or the overflow, by how far off it is"""
+        due = int(timestamp // self.tick)
+        delta = due - self.current
+        if delta <= 0:
+            heapq.heappush(self.heap, (timestamp, message_id))
+            return
+        slots = self.slots
+        for level, span in enumerate(self.spans):
+            if delta < span * slots:
+                slot = due // span % slots
+                self.wheels[level][slot][message_id] = timestamp
+                self.counts[level] += 1
+                self.places[message_id] = (level, slot)
+                return
+        self.overflow[message_id] = timestamp
+
+
+    def unplace(self, message_id):
+        """
+        Takes a message out of its wheel or the overflow
+        Heap entries are left, and skipped once they're stale
+        """
+        place = self.places.pop(message_id, None)
+        if place is not None:
+            level, slot = place
+            del self.wheels[level][slot][message_id]
+            self.counts[level] -= 1
+        self.overflow.pop(message_id, None)
+
+
+    def cascade(self):
+        """Moves the slots the wheels just turned to down, from the top wheel first"""
+
+        if self.current % self.slots ** self.levels == 0:
+            overflow = self.overflow
+            self.overflow = {}
+            for message_id, timestamp in overflow.items():
+                self.place(timestamp, message_id)
+
+        # the bottom wheel's slot goes into the heap
+        for level in range(self.levels - 1, -1, -1):
+            span = self.spans[level]
+            if self.current % span:
+                continue
+            slot = self.current // span % self.slots
+            bucket = self.wheels[level][slot]
+            if not bucket:
+                continue
+            self.wheels[level][slot] = {}
+            self.counts[level] -= len(bucket)
+            for message_id, timestamp in bucket.items():
+                del self.places[message_id]
+                self.place(timestamp, message_id)
+
+
+    def advance(self, now):
+        """
+        Turns the wheels to now's tick, moving every message due by then
+        into the heap, and jumping straight past turns of empty wheels
+        """
+
+        target = int(now // self.tick)
+        while self.current < target:
+            # the lowest wheel with messages sets how far is safe to jump
+            step = 1
+            for count in self.counts:
+                if count:
+                    break
+                step *= self.slots
+            else:
+                if not self.overflow:
+                    self.current = target
+                    return
+            boundary = (self.current // step + 1) * step
+            if boundary > target:
+                self.current = target
+                return
+            self.current = boundary
+            self.cascade()
+
+
+    def load(self, pending):
+        """Replaces the schedule with the given (timestamp, id) pairs, in one pass"""
+        with self.lock:
+            self.reset()
+            for timestamp, message_id in pending:
+                if message_id in self.entries:
+                    self.unplace(message_id)
+                self.entries[message_id] = timestamp
+                self.place(timestamp, message_id)
+        self.wake()
+
+
+    def _merge(self, batch):
+        for timestamp, message_id in batch:
+            if timestamp > self.entries.get(message_id, -1):
+                self.unplace(message_id)
+                self.entries[message_id] = timestamp
+                self.place(timestamp, message_id)
+
+
+    def push(self, timestamp, message_id):
+        with self.lock:
+            self.unplace(message_id)
+            self.entries[message_id] = timestamp
+            self.place(timestamp, message_id)
+            # anything waiting may now have an earlier deadline
+            if self.deadline is not None and timestamp >= self.deadline:
+                return
+        self.wake()
+
+
+    def cancel(self, message_id):
+        with self.lock:
+            if self.entries.pop(message_id, None) is None:
+                return False
+            self.unplace(message_id)
+            return True
+
+
+    def next_deadline(self):
+        """
+        Returns the timestamp of the earliest pending message, or None
+        That is the top of the heap, or else the earliest message in the
+        next full slot of any wheel, since each wheel covers one turn
+        """
+
+        with self.lock:
+            self._discard_stale()
+            if self.heap:
+                self.deadline = self.heap[0][0]
+                return self.deadline
+
+            candidates = []
+            for level in range(self.levels):
+                if not self.counts[level]:
+                    continue
+                turn = self.current // self.spans[level]
+                for offset in range(1, self.slots + 1):
+                    bucket = self.wheels[level][(turn + offset) % self.slots]
+                    if bucket:
+                        candidates.append(min(bucket.values()))
+                        break
+            if self.overflow:
+                candidates.append(min(self.overflow.values()))
+            self.deadline = min(candidates) if candidates else None
+            return self.deadline
+
+
+    def pop_due(self, now, limit=None):
+        with self.lock:
+            self.advance(now)
+            # the next push has to wake wait() until it reads a new deadline
+            self.deadline = None
+            return scheduler.Scheduler.pop_due(self, now, limit)
@@ -0,0 +1,52 @@
+#!usr/bin/python
+
+# a timed sleep that another thread can cut short, without polling
+
+from __future__ import unicode_literals
+
+import os
+import fcntl
+import errno
+import select
+
+
+class Wakeup(object):
+
+    def __init__(self):
+        """
+        Wakeup blocks in select() on a pipe, which (unlike a timed
+        Condition.wait or Event.wait in python 2) sleeps without polling
+        Meant for a single waiting thread
+        """
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+    def wait(self, timeout):
+        """Sleeps until wake() is called or timeout seconds pass"""
+        if timeout > 0:
+            # a wake() before this has already written to the pipe,
+            # so select returns straight away instead of missing it
+            try:
+                select.select([self.read_fd], [], [], timeout)
+            except select.error as e:
+                # a signal arrived, the caller will just wait again
+                if e.args[0] != errno.EINTR:
+                    raise
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+    def wake(self):
+        """Wakes up the thread in wait(), ie when shutting down"""
+        try:
+            os.write(self.write_fd, b"!")
+        except OSError as e:
+            # the pipe is full, so the waiter is already due to wake up
+            if e.errno != errno.EAGAIN:
+                raise